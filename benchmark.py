@@ -0,0 +1,1192 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for server-worker.py that run completely offline against synthetic COGs served from a local HTTP server
+Usage: python3 benchmark.py download [--items 4] [--latency 0.05]
+       python3 benchmark.py blocks
+       python3 benchmark.py indices [--size 2000] [--resampling nearest]
+       python3 benchmark.py server [--clients 16] [--stac-latency 2]
+       python3 benchmark.py clouds [--items 20] [--max-cloud-cover 50]
+       python3 benchmark.py tiled [--aoi 0.25 0.5 1] [--tile-blocks 1]
+       python3 benchmark.py outputs [--size 2000] [--noise 30]
+       python3 benchmark.py datacube [--items 6] [--aoi 0.5]
+       python3 benchmark.py flaky [--items 6] [--failure-rate 0.1] [--stall-rate 0.02]
+       python3 benchmark.py gdal [--items 4] [--aoi 0.5] [--latency 0.02]
+       python3 benchmark.py cpu [--items 8] [--workers <number of CPUs>]
+       python3 benchmark.py batch [--plots 50] [--plot-size 200] [--threads 16]
+       python3 benchmark.py e2e [--jobs 4] [--items 6] [--bandwidth 200] [--json results.jsonl]
+       python3 benchmark.py ui [--loads 200]
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import functools
+import io
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+import zipfile
+
+from threading import Thread, Lock
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rasterio.warp import transform_bounds
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # server-worker.py reads job-schema.json relative to the working directory
+spec = importlib.util.spec_from_file_location('server_worker', 'server-worker.py')
+sw = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = sw  # so that functions of it can be sent to the processes of its CPU pool
+spec.loader.exec_module(sw)
+
+
+###############################################################################
+
+
+BANDS_10M = ['blue', 'green', 'red', 'nir']
+BANDS_20M = ['rededge1', 'rededge2', 'rededge3', 'nir08', 'swir16', 'swir22', 'scl']
+BANDS_60M = ['coastal', 'nir09']
+ORIGIN = (399960, 6000000)  # upper left corner of MGRS tile 33UUV, all synthetic scenes share it
+TILE_SIZE_M = 20480  # a bit more than 1/5 of a real tile keeps the fixtures small while still having several internal blocks
+
+# Share of cloudy pixels in the SCL of the i-th synthetic scene, varies between 0 and 1 over the scenes
+def scene_cloudiness(i):
+    return (i * 37 % 101) / 100
+
+def make_cog(filename, resolution, dtype='uint16', seed=0, cloudiness=0.5, blocksize=None):
+    size = TILE_SIZE_M // resolution
+    rng = np.random.default_rng(seed)
+    if dtype == 'uint8':  # SCL with patches of clouds (classes 8-10) over vegetation, bare soil and water (classes 4-6)
+        patches = rng.random((size//32 + 1, size//32 + 1))
+        cloudy = np.repeat(np.repeat(patches, 32, axis=0), 32, axis=1)[:size, :size] < cloudiness
+        data = np.where(cloudy, rng.integers(8, 11, (size, size)), rng.integers(4, 7, (size, size))).astype('uint8')
+    else:  # reflectance-like values with some spatial structure so the compression has something to do
+        y, x = np.mgrid[0:size, 0:size]
+        data = (1000 + 500*np.sin(x/37) + 500*np.cos(y/23) + rng.integers(0, 200, (size, size))).astype(dtype)
+    with rasterio.open(
+        filename,
+        'w',
+        driver='COG',
+        width=size,
+        height=size,
+        count=1,
+        dtype=dtype,
+        crs='EPSG:32633',
+        transform=from_origin(*ORIGIN, resolution, resolution),
+        compress='deflate',
+        blocksize=blocksize or (256 if resolution > 10 else 512),
+        overview_resampling='nearest' if dtype == 'uint8' else 'average',
+        nodata=0
+    ) as dst:
+        dst.write(data, 1)
+
+# Creates `n` scenes with all bands of a Sentinel-2 L2A item below `directory` and returns their relative paths as {band: path}
+# By default the COGs have smaller blocks than real ones (so that the small fixtures still have several of them)
+def make_scenes(directory, n, blocksize=None):
+    scenes = []
+    for i in range(n):
+        scene = {}
+        os.makedirs(os.path.join(directory, 'scene%d' % i), exist_ok=True)
+        for resolution, bands in [(10, BANDS_10M), (20, BANDS_20M), (60, BANDS_60M)]:
+            for band in bands:
+                path = 'scene%d/%s.tif' % (i, band)
+                make_cog(os.path.join(directory, path), resolution, 'uint8' if band == 'scl' else 'uint16', seed=i, cloudiness=scene_cloudiness(i), blocksize=blocksize)
+                scene[band] = path
+        scenes.append(scene)
+    return scenes
+
+# STAC items (as dicts) for scenes created by `make_scenes` and served at `base_url`, one day apart
+def make_stac_items(scenes, base_url):
+    bounds = transform_bounds(32633, 4326, ORIGIN[0], ORIGIN[1]-TILE_SIZE_M, ORIGIN[0]+TILE_SIZE_M, ORIGIN[1])
+    items = []
+    for i, scene in enumerate(scenes):
+        day = '2024-03-%02d' % (5+i)
+        items.append({
+            'type': 'Feature',
+            'stac_version': '1.0.0',
+            'id': 'S2A_33UUV_%s_0_L2A' % day.replace('-', ''),
+            'bbox': list(bounds),
+            'geometry': {'type': 'Polygon', 'coordinates': [[[bounds[0], bounds[1]], [bounds[2], bounds[1]], [bounds[2], bounds[3]], [bounds[0], bounds[3]], [bounds[0], bounds[1]]]]},
+            'properties': {
+                'datetime': day + 'T10:00:00Z',
+                'eo:cloud_cover': scene_cloudiness(i) * 100,
+                'mgrs:utm_zone': 33,
+                'mgrs:latitude_band': 'U',
+                'mgrs:grid_square': 'UV',
+                's2:datatake_id': 'GS2A_%sT100000_000000_N05.10' % day.replace('-', ''),
+            },
+            'links': [],
+            'assets': {band: {'href': base_url + path, 'type': 'image/tiff; application=geotiff; profile=cloud-optimized'} for band, path in scene.items()},
+        })
+    return items
+
+# A bbox in EPSG:4326 that lies within all synthetic scenes, `fraction` is its size relative to the scene
+def make_bbox(fraction=0.5):
+    margin = TILE_SIZE_M * (1-fraction) / 2
+    bounds = (ORIGIN[0]+margin, ORIGIN[1]-TILE_SIZE_M+margin, ORIGIN[0]+TILE_SIZE_M-margin, ORIGIN[1]-margin)
+    return list(transform_bounds(32633, 4326, *bounds))
+
+
+###############################################################################
+
+
+# Serves files with support for HTTP range requests (like S3 does), an artificial delay per request and optionally a
+# limited `bandwidth` (bytes per second, shared by all connections like a network link)
+# `requests` and `bytes_sent` are shared counters because the server runs in its own process
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    latency = 0
+    bandwidth = 0
+    link_lock = Lock()
+    link_free_at = [0]  # when the link has sent everything that was written to it so far
+    requests = None
+    bytes_sent = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, nbytes):
+        with self.requests.get_lock():
+            self.requests.value += 1
+            self.bytes_sent.value += nbytes
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = self.translate_path(self.path.split('?')[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size-1
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].replace('bytes=', '').split(',')[0].split('-')
+            start = int(first)
+            end = min(int(last), size-1) if last else size-1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end-start+1))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            self.send_throttled(f.read(end-start+1))
+        self.count(end-start+1)
+
+    def send_throttled(self, content):
+        if not self.bandwidth:
+            self.wfile.write(content)
+            return
+        for offset in range(0, len(content), 65536):
+            chunk = content[offset:offset+65536]
+            with self.link_lock:
+                done = max(time.monotonic(), self.link_free_at[0]) + len(chunk) / self.bandwidth
+                self.link_free_at[0] = done
+            time.sleep(max(0, done - time.monotonic()))
+            self.wfile.write(chunk)
+
+    def do_HEAD(self):
+        time.sleep(self.latency)
+        self.count(0)
+        super().do_HEAD()
+
+# Same, but like an overloaded object store: a `failure_rate` share of the requests is answered with 503 and a
+# `stall_rate` share hangs for `stall` seconds first (longer than the client waits), requests for paths that contain
+# `broken` always fail. `faults` counts the injected faults.
+class FlakyRequestHandler(RangeRequestHandler):
+    failure_rate = 0
+    stall_rate = 0
+    stall = 0
+    broken = None
+    faults = None
+
+    # Returns whether the request has been answered with an error
+    def inject_fault(self):
+        chance = random.random()
+        if chance < self.failure_rate + self.stall_rate or (self.broken and self.broken in self.path):
+            with self.faults.get_lock():
+                self.faults.value += 1
+        if chance < self.failure_rate or (self.broken and self.broken in self.path):
+            self.send_error(503, 'Slow Down')
+            return True
+        if chance < self.failure_rate + self.stall_rate:
+            time.sleep(self.stall)
+        return False
+
+    def do_GET(self):
+        try:
+            if not self.inject_fault():
+                super().do_GET()
+        except (BrokenPipeError, ConnectionResetError):  # the client gave up on a stalled request
+            pass
+
+    def do_HEAD(self):
+        try:
+            if not self.inject_fault():
+                super().do_HEAD()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+# Same, but with keep-alive connections (like S3), `connections` counts how many were opened
+class KeepAliveRequestHandler(RangeRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = None
+
+    def setup(self):
+        super().setup()
+        with self.connections.get_lock():
+            self.connections.value += 1
+
+class Server:
+    def __init__(self, process, handler, url):
+        self.process = process
+        self.handler = handler
+        self.url = url
+
+    @property
+    def requests(self):
+        return self.handler.requests.value
+
+    @property
+    def bytes_sent(self):
+        return self.handler.bytes_sent.value
+
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join()
+
+# A minimal STAC API: a landing page and a /search endpoint that returns all `items` (STAC item dicts) after `latency`
+class StacHandler(BaseHTTPRequestHandler):
+    latency = 0
+    items = []
+    requests = None
+    bytes_sent = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.requests.get_lock():
+            self.requests.value += 1
+            self.bytes_sent.value += len(body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        root = 'http://' + self.headers['Host'] + '/'
+        self.send_json({
+            'type': 'Catalog',
+            'id': 'stub',
+            'stac_version': '1.0.0',
+            'description': 'Local stand-in for the Element84 Earth Search API',
+            'conformsTo': ['https://api.stacspec.org/v1.0.0/core', 'https://api.stacspec.org/v1.0.0/item-search'],
+            'links': [
+                {'rel': 'self', 'href': root},
+                {'rel': 'root', 'href': root},
+                {'rel': 'search', 'href': root + 'search', 'method': 'POST', 'type': 'application/geo+json'},
+            ],
+        })
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length'] or 0))
+        time.sleep(self.latency)
+        self.send_json({'type': 'FeatureCollection', 'features': self.items, 'numberMatched': len(self.items), 'numberReturned': len(self.items), 'links': []})
+
+# The default backlog of 5 makes additional concurrent connections wait for a SYN retry (1 s)
+class BacklogHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+
+# The servers have to live in separate processes: with a server thread in the same interpreter, `rasterio.open` on its
+# URLs never returns
+def start_server(directory, handler_class=RangeRequestHandler, **attributes):
+    context = multiprocessing.get_context('fork')
+    handler = type('Handler', (handler_class,), {'requests': context.Value('q', 0), 'bytes_sent': context.Value('q', 0), **attributes})
+    if directory is not None:
+        handler = functools.partial(handler, directory=directory)
+    httpd = BacklogHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    process = context.Process(target=httpd.serve_forever, daemon=True)
+    process.start()
+    httpd.socket.close()  # only the child process accepts connections
+    return Server(process, handler if directory is None else handler.func, 'http://127.0.0.1:%d/' % httpd.server_address[1])
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def serve_quietly(server_class, port):
+    logging.disable(logging.CRITICAL)
+    sys.stderr = open(os.devnull, 'w')  # BaseHTTPRequestHandler logs every request there
+    sw.run_server(server_class, port=port)
+
+# Runs the HTTP front end of server-worker.py (without any job workers) in its own process
+def start_frontend(server_class, stac_url):
+    sw.STAC_URL = stac_url
+    port = free_port()
+    process = multiprocessing.get_context('fork').Process(target=serve_quietly, args=(server_class, port), daemon=True)
+    process.start()
+    url = 'http://127.0.0.1:%d/' % port
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + 'api/queue/length').read()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, url
+
+
+###############################################################################
+
+
+def bench_download(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        server = start_server(tmp, latency=args.latency)
+        bbox = make_bbox()
+        bands = BANDS_10M + BANDS_20M[:-1] + BANDS_60M
+        os.makedirs(os.path.join(tmp, 'out'))
+
+        # the `run` query parameter gives every run its own URLs, so GDAL can't answer anything from its cache
+        def tasks(run):
+            for i, scene in enumerate(scenes):
+                for band in bands:
+                    yield server.url + scene[band] + '?run=' + run, os.path.join(tmp, 'out', '%s-%d-%s.tif' % (run, i, band))
+
+        sw.tile_cache = sw.TileCache(None, 0)  # measure the network, not the local cache
+
+        t = time.perf_counter()
+        for url, filename in tasks('sequential'):
+            sw.save_cog_subset(url, bbox, filename)
+        sequential = time.perf_counter() - t
+
+        def fetch_and_save(url, filename):
+            sw.save_as_tiff(*sw.fetch_cog_subset(url, bbox), filename)
+
+        t = time.perf_counter()
+        futures = [sw.download_pool.submit(fetch_and_save, url, filename) for url, filename in tasks('concurrent')]
+        for future in futures:
+            future.result()
+        concurrent = time.perf_counter() - t
+
+        server.shutdown()
+        print(f"{args.items} items x {len(bands)} bands with {args.latency*1000:.0f} ms latency per request")
+        print(f"sequential:  {sequential:8.2f} s")
+        print(f"concurrent:  {concurrent:8.2f} s  ({sw.DOWNLOAD_THREADS} threads, {sw.DOWNLOAD_THREADS_PER_HOST} per host)")
+        print(f"speedup:     {sequential/concurrent:8.2f} x")
+
+
+# The nearest-neighbour upsampling by pixel doubling the legacy formulas used for 20 m bands
+# Overlapping windows of a COG with 256 px blocks read through the tile cache: checks that each read downloads only the
+# blocks that aren't cached yet (or the smallest rectangle of blocks around them) and returns the same pixels as a
+# direct read. Exits with an error otherwise.
+def bench_blocks(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        make_cog(os.path.join(tmp, 'band.tif'), 20, blocksize=256)  # 1024 x 1024 px, i.e. 4 x 4 blocks
+        url = 'file://' + os.path.join(tmp, 'band.tif')
+        sw.tile_cache = sw.TileCache(os.path.join(tmp, 'cache'), 1024**3)
+        stats = sw.Stats()
+        sw.current_stats.set((stats,))
+        reads = [  # window (col, row, width, height), expected blocks downloaded and cached
+            ((0, 0, 512, 512), 4, 0),
+            ((256, 0, 512, 512), 2, 2),  # the left half is cached
+            ((0, 0, 768, 512), 0, 6),
+            ((0, 768, 256, 256), 1, 0),
+            ((512, 768, 256, 256), 1, 0),
+            ((0, 768, 1024, 256), 3, 1),  # the 2 missing blocks and the cached one between them
+            ((100, 100, 50, 50), 0, 1),
+        ]
+        print(f"{'window':>24}{'downloaded':>12}{'cached':>8}{'KiB read':>10}")
+        ok = True
+        with rasterio.open(url) as src:
+            for window, downloaded, cached in reads:
+                before = stats.as_dict()
+                chunk, _ = sw.read_cog_window(url, Window(*window))
+                after = stats.as_dict()
+                delta = lambda counter: after['counters'].get(counter, 0) - before['counters'].get(counter, 0)
+                nbytes = after['stages'].get('read', {}).get('bytes', 0) - before['stages'].get('read', {}).get('bytes', 0)
+                same = np.array_equal(chunk, src.read(1, window=Window(*window)))
+                expected = (delta('blocks_downloaded'), delta('blocks_cached')) == (downloaded, cached)
+                ok = ok and same and expected
+                print(f"{str(window):>24}{delta('blocks_downloaded'):12d}{delta('blocks_cached'):8d}{nbytes/1024:10.0f}"
+                      + ('' if expected else f"   expected {downloaded} and {cached}") + ('' if same else "   DIFFERENT data"))
+        print("ok" if ok else "FAILED")
+        if not ok:
+            sys.exit(1)
+
+def resample_to_same_shape(finer_array, coarser_array):
+    doubled_v = np.repeat(coarser_array, 2, axis=0)
+    doubled_vh = np.repeat(doubled_v, 2, axis=1)
+    result2 = doubled_vh
+    shape_to_match = np.shape(result2)
+    shape_of_finer = np.shape(finer_array)
+    result1 = finer_array
+    if shape_of_finer[0] > shape_to_match[0]:
+        result1 = np.delete(result1, shape_of_finer[0]-1, 0)
+    if shape_of_finer[1] > shape_to_match[1]:
+        result1 = np.delete(result1, shape_of_finer[1]-1, 1)
+    if shape_of_finer[0] < shape_to_match[0]:
+        result2 = np.delete(result2, shape_to_match[0]-1, 0)
+        shape_to_match = (shape_to_match[0]-1, shape_to_match[1])
+    if shape_of_finer[1] < shape_to_match[1]:
+        result2 = np.delete(result2, shape_to_match[1]-1, 1)
+        shape_to_match = (shape_to_match[0], shape_to_match[1]-1)
+    return result1, result2, shape_to_match
+
+# The index formulas as they were before the index engine: everything in float64 with full-size temporaries, one
+# index at a time
+def legacy_index(indexname, bands):
+    if indexname in ['ndvi', 'ndyi', 'ndre', 'ndsi', 'ngrdi', 'mois', 'vari', 'msi']:
+        band1, band2 = [bands[name][0].astype('float64') for name in sw.BANDS_FOR_INDICES[indexname][:2]]
+        if band1.shape[0] > band2.shape[0]:
+            band1, band2, _ = resample_to_same_shape(band1, band2)
+        elif band1.shape[0] < band2.shape[0]:
+            band2, band1, _ = resample_to_same_shape(band2, band1)
+        numerator = (band1-band2)
+        denominator = (band1+band2)
+        if indexname == 'msi':
+            numerator = band1
+            denominator = band2
+        if indexname == 'vari':
+            denominator -= bands['blue'][0].astype('float64')
+        return np.where(denominator==0., 0, numerator/denominator)
+    if indexname == 'evi':
+        red, nir, blue = [bands[name][0].astype('float64') / 10000 for name in ['red', 'nir', 'blue']]
+        denominator = (nir + 6*red - 7.5*blue + 1)
+        return np.clip(np.where(denominator==0., 0, 2.5*((nir-red)/denominator)), -1, 1)
+    if indexname == 'reip':
+        red, re1, re2, re3 = [bands[name][0].astype('float64') for name in ['red', 'rededge1', 'rededge2', 'rededge3']]
+        _, re1, _ = resample_to_same_shape(red, re1)
+        _, re2, _ = resample_to_same_shape(red, re2)
+        red, re3, _ = resample_to_same_shape(red, re3)
+        denominator = (re2-re1)
+        return np.where(denominator==0., 0, 700+40*(((red+re3)/2)-re1/denominator))
+    if indexname == 'msavi':
+        red, nir = [bands[name][0].astype('float64') for name in ['red', 'nir']]
+        radicand = np.square(2*nir+1) - 8*(nir-red)
+        return np.where(radicand<0, 0, 2*nir+1-np.sqrt(radicand)/2)
+
+def make_bands(size):
+    rng = np.random.default_rng(0)
+    bands = {}
+    for resolution, names in [(10, BANDS_10M), (20, BANDS_20M[:-1])]:
+        shape = (size * 10 // resolution, size * 10 // resolution)
+        metadata = sw.Metadata(shape[1], shape[0], 'EPSG:32633', from_origin(*ORIGIN, resolution, resolution))
+        for name in names:
+            bands[name] = (rng.integers(1, 10000, shape, dtype='uint16'), metadata)
+    return bands
+
+# Returns (seconds, peak bytes allocated, {indexname: result}), results are only kept if `keep` is set
+def measure(function, keep):
+    results = {}
+    tracemalloc.start()
+    t = time.perf_counter()
+    for indexname, result in function():
+        results[indexname] = result if keep else result.nbytes
+    seconds = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak, results
+
+def bench_indices(args):
+    bands = make_bands(args.size)
+    indexnames = list(sw.BANDS_FOR_INDICES)
+    legacy = lambda: ((indexname, legacy_index(indexname, bands)) for indexname in indexnames)
+    engine = lambda: ((indexname, result) for indexname, result, _ in sw.compute_indices(indexnames, bands, args.resampling))
+
+    with np.errstate(divide='ignore', invalid='ignore'):  # the legacy formulas divide by zero before masking
+        legacy_seconds, legacy_peak, legacy_bytes = measure(legacy, False)
+        engine_seconds, engine_peak, engine_bytes = measure(engine, False)
+        _, _, legacy_results = measure(legacy, True)
+        _, _, engine_results = measure(engine, True)
+    # the maximum isn't meaningful: where float64 rounding leaves a tiny non-zero denominator, the legacy EVI clips to -1/1 instead of 0
+    deviation = max(float(np.quantile(np.abs(legacy_results[name] - engine_results[name]) / np.maximum(np.abs(legacy_results[name]), 1), 0.9999)) for name in indexnames)
+
+    print(f"{len(indexnames)} indices on {args.size}x{args.size} pixels at 10 m")
+    print(f"              time      peak memory  output size")
+    print(f"legacy:   {legacy_seconds:7.2f} s  {legacy_peak/1024**2:8.0f} MiB  {sum(legacy_bytes.values())/1024**2:8.0f} MiB")
+    print(f"engine:   {engine_seconds:7.2f} s  {engine_peak/1024**2:8.0f} MiB  {sum(engine_bytes.values())/1024**2:8.0f} MiB  ({sw.INDEX_DTYPE}, {args.resampling})")
+    print(f"relative deviation (99.99th percentile, worst index): {deviation:.2e}")
+
+
+def percentiles(latencies):
+    latencies = np.array(latencies) * 1000
+    return '  '.join(f"{p:>5}: {np.percentile(latencies, p) if len(latencies) else np.nan:8.1f} ms" for p in [50, 90, 99]) + f"  max: {np.max(latencies) if len(latencies) else np.nan:8.1f} ms"
+
+# Some clients keep checking searches (which take `stac_latency` at the catalog), all others keep polling the progress
+# like the UI does. Reports the latencies the polling clients see.
+def bench_server(args):
+    stac = start_server(None, StacHandler, latency=args.stac_latency)
+    bbox = [13.18260, 53.81978, 13.286973, 53.840044]
+    order = json.dumps({'bbox': bbox, 'start': '2024-03-05', 'end': '2024-03-09', 'max_cloud_cover': 50, 'bands': ['red'], 'indices': [], 'other': [], 'pattern': 'yymmdd-tile-name.tiff'}).encode('utf-8')
+    print(f"{args.clients} clients for {args.duration} s, {args.checkers} of them checking searches that take {args.stac_latency} s, the others polling progress")
+
+    for server_class in [HTTPServer, ThreadingHTTPServer]:
+        process, url = start_frontend(server_class, stac.url)
+        deadline = time.perf_counter() + args.duration
+        latencies = []
+        checks = []
+
+        def poll():
+            while time.perf_counter() < deadline:
+                t = time.perf_counter()
+                urllib.request.urlopen(url + 'api/jobs/current/percentage', timeout=60).read()
+                latencies.append(time.perf_counter() - t)
+
+        def check():
+            while time.perf_counter() < deadline:
+                t = time.perf_counter()
+                urllib.request.urlopen(urllib.request.Request(url + 'api/check', data=order, headers={'Content-Type': 'application/json'}), timeout=60).read()
+                checks.append(time.perf_counter() - t)
+
+        threads = [Thread(target=check if i < args.checkers else poll) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        process.terminate()
+        process.join()
+        print(f"{server_class.__name__:>20}  {len(latencies):6d} polls  {percentiles(latencies)}  ({len(checks)} checks)")
+
+    stac.shutdown()
+
+
+# Bytes and requests needed to decide which scenes to skip: full resolution SCL for every scene vs. the staged filter
+def bench_clouds(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        bbox = make_bbox(args.aoi)
+        sw.tile_cache = sw.TileCache(None, 0)  # measure the network, not the local cache
+        import pystac
+
+        results = {}
+        full_resolution = lambda item: sw.get_cloud_cover(sw.fetch_cog_subset(item.assets['scl'].href, bbox)[0]) <= args.max_cloud_cover/100
+        for name, function in [('full resolution', lambda items: list(sw.download_pool.map(full_resolution, items))),
+                               ('staged', lambda items: sw.filter_cloudy_items([[item] for item in items], bbox, args.max_cloud_cover))]:
+            server = start_server(tmp, latency=args.latency)  # a new server (i.e. new URLs) per run so GDAL can't use its cache
+            items = [pystac.Item.from_dict(item) for item in make_stac_items(scenes, server.url)]
+            t = time.perf_counter()
+            keep = function(items)
+            results[name] = (time.perf_counter() - t, server.requests, server.bytes_sent, keep)
+            server.shutdown()
+
+        print(f"{args.items} scenes, AOI {args.aoi*100:.0f}% of the scene, max. cloud cover {args.max_cloud_cover}%, {args.latency*1000:.0f} ms latency per request")
+        for name, (seconds, requests, nbytes, keep) in results.items():
+            print(f"{name:>16}: {seconds:6.2f} s  {requests:5d} requests  {nbytes/1024**2:8.2f} MiB  {sum(keep)} scenes kept")
+        print("same decisions" if results['full resolution'][3] == results['staged'][3] else "DIFFERENT decisions")
+
+
+# Processes one scene for AOIs of growing size, once with whole arrays and once tile by tile, and compares the results
+def bench_tiled(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, 1)
+        import pystac
+        items = [pystac.Item.from_dict(item) for item in make_stac_items(scenes, tmp + '/')]
+        sw.TILE_BLOCKS = args.tile_blocks
+        sw.tile_cache = sw.TileCache(None, 0)
+        os.chdir(tmp)  # the jobs end up in ./jobs
+        os.makedirs('jobs')
+
+        def run(jobname, aoi, tiled):
+            data = {'bbox': make_bbox(aoi), 'start': '2024-03-05', 'end': '2024-03-06', 'max_cloud_cover': 0, 'bands': ['red', 'nir', 'swir16'],
+                    'indices': list(sw.BANDS_FOR_INDICES), 'other': ['tci'], 'pattern': 'yymmdd-tile-name.tiff', 'jobname': jobname}
+            sw.TILED_MODE_PIXELS = 0 if tiled else 10**12
+            sw.submit_job(data, len(items))
+            tracemalloc.start()
+            t = time.perf_counter()
+            sw.process_job(data, items)
+            seconds = time.perf_counter() - t
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with zipfile.ZipFile(os.path.join('jobs', jobname, jobname + '.zip')) as archive:
+                contents = {}
+                for name in archive.namelist():
+                    if name.endswith('.tiff'):
+                        with MemoryFile(archive.read(name)) as memfile, memfile.open() as src:
+                            contents[name] = (src.read().tobytes(), src.transform, src.crs, src.dtypes[0])
+            return seconds, peak, contents
+
+        print(f"1 scene, {len(sw.BANDS_FOR_INDICES)} indices, 3 bands and the TCI, tiles of {args.tile_blocks}x{args.tile_blocks} blocks, peak memory of numpy arrays")
+        print(f"                         whole arrays            tiled")
+        for aoi in args.aoi:
+            whole_seconds, whole_peak, whole = run('whole-%g' % aoi, aoi, False)
+            tiled_seconds, tiled_peak, tiled = run('tiled-%g' % aoi, aoi, True)
+            pixels = sw.count_aoi_pixels([items[0]], ['red'], make_bbox(aoi))
+            print(f"{pixels/1e6:5.1f} Mpx at 10 m:  {whole_seconds:6.2f} s {whole_peak/1024**2:6.0f} MiB   {tiled_seconds:6.2f} s {tiled_peak/1024**2:6.0f} MiB   "
+                  + ("identical" if whole == tiled else "DIFFERENT results"))
+
+
+# Bands for `bench_outputs` that look a bit more like real ones than the fixtures of `make_cog`: every band has its own
+# smooth pattern (fields, so to speak) plus `noise` DN of sensor noise
+def make_output_bands(size, noise):
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size]
+    metadata = sw.Metadata(size, size, 'EPSG:32633', from_origin(*ORIGIN, 10, 10), 0)
+    bands = {}
+    for i, (name, mean, amplitude) in enumerate([('blue', 400, 200), ('green', 700, 300), ('red', 800, 400), ('nir', 3000, 1500)]):
+        pattern = np.sin(x/(53+7*i) + i) * np.cos(y/(41+5*i)) + 0.5*np.sin((x+y)/(97+11*i))
+        data = mean + amplitude*pattern + rng.integers(0, noise+1, (size, size))
+        bands[name] = (data.astype('uint16'), metadata)
+    return bands
+
+# Writes a band, an index and the TCI with every output profile and reports the bytes that end up in the job's ZIP
+# archive (uncompressed GeoTIFFs get deflated by the archive, the others are only stored; the COGs include overviews)
+def bench_outputs(args):
+    bands = make_output_bands(args.size, args.noise)
+    _, ndvi, ndvi_metadata = next(sw.compute_indices(['ndvi'], bands))
+    outputs = {
+        'band':  bands['red'],
+        'index': (ndvi, ndvi_metadata),
+        'tci':   (np.stack([bands[band][0] for band in ['red', 'green', 'blue']]), bands['red'][1]),
+    }
+
+    print(f"{args.size}x{args.size} pixels with {args.noise} DN of noise, MiB in the archive (and seconds to write and add them)")
+    print(f"{'':>12}" + ''.join(f"{name:>20}" for name in outputs) + f"{'total':>20}")
+    for profile in sw.OUTPUT_PROFILES:
+        row = f"{profile:>12}"
+        total_bytes, total_seconds, error = 0, 0, 0
+        for name, (data, metadata) in outputs.items():
+            t = time.perf_counter()
+            content = sw.tiff_bytes(data, metadata, profile)
+            with zipfile.ZipFile(io.BytesIO(), 'w') as archive:
+                compress_type = zipfile.ZIP_STORED if sw.is_compressed(profile) else zipfile.ZIP_DEFLATED
+                archive.writestr(zipfile.ZipInfo(name + '.tiff'), content, compress_type)
+                nbytes = archive.infolist()[0].compress_size
+            seconds = time.perf_counter() - t
+            with MemoryFile(content) as memfile, memfile.open() as src:
+                error = max(error, float(np.max(np.abs(src.read().reshape(data.shape).astype('float64') - data))))
+            row += f"{nbytes/1024**2:9.2f} ({seconds:5.2f} s)"
+            total_bytes += nbytes
+            total_seconds += seconds
+        print(row + f"{total_bytes/1024**2:9.2f} ({total_seconds:5.2f} s)   max. error {error:g}")
+
+# Runs the same job over a few scenes into a ZIP archive of COGs and into a NetCDF datacube and compares the number of
+# files, the size of the download and the time of the job (and of its 'write' and 'archive' stages)
+def bench_datacube(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        import pystac
+        items = [pystac.Item.from_dict(item) for item in make_stac_items(scenes, tmp + '/')]
+        sw.tile_cache = sw.TileCache(None, 0)
+        os.chdir(tmp)  # the jobs end up in ./jobs
+        os.makedirs('jobs')
+        logging.disable(logging.INFO)
+
+        print(f"{args.items} scenes, 4 bands and {len(sw.BANDS_FOR_INDICES)} indices each")
+        print(f"{'':>10}{'files':>8}{'MiB':>10}{'job s':>8}{'write s':>10}{'archive s':>11}")
+        for output_format in ['geotiff', 'netcdf']:
+            jobname = 'bench-' + output_format
+            data = {'bbox': make_bbox(args.aoi), 'start': '2024-03-05', 'end': '2024-03-31', 'max_cloud_cover': 0, 'bands': ['blue', 'green', 'red', 'nir'],
+                    'indices': list(sw.BANDS_FOR_INDICES), 'other': [], 'pattern': 'yymmdd-tile-name.tiff', 'jobname': jobname,
+                    'output_profile': 'cog-deflate', 'output_format': output_format}
+            sw.submit_job(data, len(items))
+            t = time.perf_counter()
+            sw.process_job(data, items)
+            seconds = time.perf_counter() - t
+            with open(os.path.join('jobs', jobname, jobname + '.report.json')) as f:
+                stages = json.load(f)['stages']
+            if output_format == 'geotiff':
+                filename = os.path.join('jobs', jobname, jobname + '.zip')
+                with zipfile.ZipFile(filename) as archive:
+                    files = len(archive.namelist())
+            else:
+                filename = os.path.join('jobs', jobname, jobname + '.nc')
+                files = 1
+            print(f"{output_format:>10}{files:8d}{os.path.getsize(filename)/1024**2:10.1f}{seconds:8.2f}"
+                  + f"{stages.get('write', {}).get('seconds', 0):10.2f}{stages.get('archive', {}).get('seconds', 0):11.2f}")
+
+# Runs the same job through a worker thread of server-worker.py against a reliable server, a flaky one and one where an
+# asset is broken for good, and compares the outputs to the reliable run. The first job can't search the catalog and
+# fails as a whole, the worker has to survive that.
+def bench_flaky(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        import pystac
+        sw.tile_cache = sw.TileCache(None, 0)
+        sw.READ_BACKOFF = args.backoff
+        sw.READ_BACKOFF_MAX = args.backoff * 8
+        sw.STAC_URL = 'http://127.0.0.1:%d/' % free_port()  # nothing listens there
+        sw.GDAL_OPTIONS['GDAL_HTTP_TIMEOUT'] = str(args.timeout)
+        os.chdir(tmp)  # the jobs end up in ./jobs
+        os.makedirs('jobs')
+        logging.disable(logging.ERROR)  # including the traceback of the job that fails on purpose
+        Thread(target=sw.run_worker, daemon=True).start()
+
+        def run(jobname, items):
+            data = {'bbox': make_bbox(args.aoi), 'start': '2024-03-05', 'end': '2024-03-31', 'max_cloud_cover': 0, 'bands': ['red', 'nir'],
+                    'indices': ['ndvi', 'ndre'], 'other': [], 'pattern': 'yymmdd-tile-name.tiff', 'jobname': jobname}
+            with sw.jobs_lock:
+                sw.jobs[jobname] = {'data': data, 'state': 'searching', 'percentage': None, 'submitted': time.time(), 'items': items}
+            counters = dict(sw.metrics.as_dict()['counters'])
+            t = time.perf_counter()
+            sw.submit_job(data, None if items is None else len(items))
+            while sw.jobs[jobname]['state'] not in ['finished', 'failed']:
+                time.sleep(0.05)
+            seconds = time.perf_counter() - t
+            delta = {counter: value - counters.get(counter, 0) for counter, value in sw.metrics.as_dict()['counters'].items()}
+            return sw.jobs[jobname]['state'], seconds, delta
+
+        def contents(jobname):
+            with zipfile.ZipFile(os.path.join('jobs', jobname, jobname + '.zip')) as archive:
+                return {name: archive.read(name) for name in archive.namelist() if name.endswith('.tiff')}
+
+        state, _, _ = run('no-catalog', None)
+        print(f"job without a reachable catalog: {state}")
+        print(f"{args.items} scenes, 2 bands and 2 indices each, {args.failure_rate:.0%} of the requests fail and {args.stall_rate:.0%} stall")
+        print(f"{'':>10}{'state':>10}{'seconds':>9}{'faults':>8}{'retries':>9}{'failed':>8}{'scenes':>8}  outputs")
+        reference = None
+        for scenario, attributes in [('reliable', {}),
+                                     ('flaky', {'failure_rate': args.failure_rate, 'stall_rate': args.stall_rate, 'stall': args.timeout * 2}),
+                                     ('broken', {'broken': scenes[-1]['nir']})]:
+            server = start_server(tmp, FlakyRequestHandler, faults=multiprocessing.get_context('fork').Value('q', 0), **attributes)
+            items = [pystac.Item.from_dict(item) for item in make_stac_items(scenes, server.url)]
+            state, seconds, counters = run(scenario, items)
+            with open(os.path.join('jobs', scenario, scenario + '.report.json')) as f:
+                report = json.load(f)
+            outputs = contents(scenario)
+            if reference is None:
+                reference = outputs
+            same = all(outputs[name] == reference[name] for name in outputs)
+            print(f"{scenario:>10}{state:>10}{seconds:9.2f}{server.handler.faults.value:8d}{counters.get('read_retries', 0):9d}{counters.get('read_failures', 0):8d}"
+                  + f"{report['scenes_processed']:>5d}/{report['scenes']:<2d}  {len(outputs)} files, " + ('identical' if same else 'DIFFERENT'))
+            for failure in report['failures']:
+                print(f"{'':>10}skipped {failure['ids']}: {failure['error']}")
+            server.shutdown()
+
+# Requests, connections and bytes per band read without any GDAL options vs. with GDAL_OPTIONS, the reads run
+# concurrently in the download pool like in a job
+def bench_gdal(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        bbox = make_bbox(args.aoi)
+        bands = BANDS_10M + BANDS_20M + BANDS_60M
+        sw.tile_cache = sw.TileCache(None, 0)  # measure the network, not the local cache
+        tuned = sw.GDAL_OPTIONS
+
+        print(f"{args.items} scenes x {len(bands)} bands, AOI {args.aoi*100:.0f}% of the scene, {args.latency*1000:.0f} ms latency per request")
+        print(f"{'':>8}{'seconds':>9}{'requests':>10}{'connections':>13}{'KiB':>9}   (per band)")
+        results = {}
+        for name, options in [('bare', {}), ('tuned', tuned)]:
+            sw.GDAL_OPTIONS = options
+            server = start_server(tmp, KeepAliveRequestHandler, latency=args.latency, connections=multiprocessing.get_context('fork').Value('q', 0))
+            t = time.perf_counter()
+            futures = [sw.download_pool.submit(sw.fetch_cog_subset, server.url + scene[band], bbox) for scene in scenes for band in bands]
+            results[name] = [future.result()[0] for future in futures]
+            seconds = time.perf_counter() - t
+            n = len(futures)
+            print(f"{name:>8}{seconds:9.2f}{server.requests/n:10.1f}{server.handler.connections.value/n:13.2f}{server.bytes_sent/n/1024:9.1f}")
+            server.shutdown()
+        sw.GDAL_OPTIONS = tuned
+        print("same data" if all(np.array_equal(a, b) for a, b in zip(results['bare'], results['tuned'])) else "DIFFERENT data")
+
+# The same job with the outputs computed in the job's thread vs. in the CPU pool, while the next scenes are downloaded
+def bench_cpu(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        sw.CPU_WORKERS = args.workers
+        sw.CPU_QUEUE = 2 * args.workers
+        sw.cpu_slots = sw.BoundedSemaphore(sw.CPU_QUEUE)
+        sw.start_cpu_pool()  # before any other threads exist
+        pool = sw.cpu_pool
+        scenes = make_scenes(tmp, args.items)
+        server = start_server(tmp, latency=args.latency)
+        import pystac
+        items = [pystac.Item.from_dict(item) for item in make_stac_items(scenes, server.url)]
+        sw.tile_cache = sw.TileCache(None, 0)
+        os.chdir(tmp)  # the jobs end up in ./jobs
+        os.makedirs('jobs')
+        logging.disable(logging.INFO)
+
+        print(f"{args.items} scenes, 4 bands, {len(sw.BANDS_FOR_INDICES)} indices and the TCI each, AOI {args.aoi*100:.0f}% of the scene, "
+              + f"{args.latency*1000:.0f} ms latency per request, {os.cpu_count()} CPUs")
+        print(f"{'':>16}{'job s':>8}{'CPU work s':>12}{'waiting for reads':>19}{'for CPU pool':>14}  outputs")
+        reference = None
+        for name, cpu_pool in [('in job thread', None), (f"{args.workers} processes", pool)]:
+            sw.cpu_pool = cpu_pool
+            jobname = 'bench-' + ('pool' if cpu_pool else 'thread')
+            data = {'bbox': make_bbox(args.aoi), 'start': '2024-03-05', 'end': '2024-03-31', 'max_cloud_cover': 0, 'bands': ['blue', 'green', 'red', 'nir'],
+                    'indices': list(sw.BANDS_FOR_INDICES), 'other': ['tci'], 'pattern': 'yymmdd-tile-name.tiff', 'jobname': jobname}
+            sw.submit_job(data, len(items))
+            t = time.perf_counter()
+            sw.process_job(data, items)
+            seconds = time.perf_counter() - t
+            with open(os.path.join('jobs', jobname, jobname + '.report.json')) as f:
+                stages = json.load(f)['stages']
+            with zipfile.ZipFile(os.path.join('jobs', jobname, jobname + '.zip')) as archive:
+                outputs = [(info.filename, archive.read(info)) for info in archive.infolist() if info.filename.endswith('.tiff')]
+            if reference is None:
+                reference = outputs
+            cpu = sum(stages.get(stage, {}).get('seconds', 0) for stage in ['resample', 'index', 'composite', 'write'])
+            print(f"{name:>16}{seconds:8.2f}{cpu:12.2f}{stages['wait']['seconds']:19.2f}{stages.get('cpu_wait', {}).get('seconds', 0):14.2f}  "
+                  + f"{len(outputs)} files, " + ('identical' if outputs == reference else 'DIFFERENT'))
+        server.shutdown()
+        pool.shutdown()
+
+# Runs the program part of s2-batch-download.py (everything after its config) with `config` in a process of its own,
+# i.e. with GDAL's caches as empty as in a separate run of the script
+def run_batch_script(config):
+    with open('s2-batch-download.py') as f:
+        program = f.read().split('# STOP STOP\n', 1)[1]
+    def run():
+        sys.stdout = open(os.devnull, 'w')  # it prints every filename
+        exec(compile(program, 's2-batch-download.py', 'exec'), {'__name__': 's2_batch_download', 'download': True, **config})
+    process = multiprocessing.get_context('fork').Process(target=run)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("s2-batch-download.py failed")
+
+# Many small AOIs (like field plots) downloaded by s2-batch-download.py with one run per AOI (like before it had a batch
+# mode) vs. one run in batch mode
+def bench_batch(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        scenes = make_scenes(tmp, args.items)
+        bands = ['blue', 'green', 'red', 'nir', 'swir16']
+        random.seed(0)
+        x1, y1, x2, y2 = make_bbox(0.9)
+        size = args.plot_size / 111000  # degrees, roughly
+        plots = []
+        for i in range(args.plots):
+            x, y = random.uniform(x1, x2 - size), random.uniform(y1, y2 - size)
+            plots.append(('plot%03d' % i, [x, y, x + size, y + size]))
+        with open(os.path.join(tmp, 'plots.csv'), 'w') as f:
+            f.write('name,xmin,ymin,xmax,ymax\n' + ''.join('%s,%r,%r,%r,%r\n' % (name, *bbox) for name, bbox in plots))
+        config = {'start': '2024-03-05', 'end': '2024-03-31', 'bands': bands, 'indices': []}
+
+        print(f"{args.plots} AOIs of {args.plot_size} m x {args.plot_size} m, {args.items} scenes, {len(bands)} bands, {args.latency*1000:.0f} ms latency per request")
+        print(f"{'':>16}{'seconds':>9}{'searches':>10}{'COG requests':>14}{'MiB':>8}{'files':>7}")
+        outputs = {}
+        for name, threads in [('one run per AOI', 1), ('batch mode', args.threads)]:
+            server = start_server(tmp, KeepAliveRequestHandler, latency=args.latency, connections=multiprocessing.get_context('fork').Value('q', 0))
+            stac = start_server(None, StacHandler, items=make_stac_items(scenes, server.url))
+            os.environ['STAC_URL'] = stac.url
+            out = os.path.join(tmp, name.replace(' ', '-'))
+            t = time.perf_counter()
+            if threads == 1:
+                for plot, bbox in plots:
+                    run_batch_script({**config, 'bbox': bbox, 'aois': None, 'threads': 1, 'pattern': os.path.join(out, plot, 'yymmdd-name.tiff')})
+            else:
+                run_batch_script({**config, 'bbox': None, 'aois': os.path.join(tmp, 'plots.csv'), 'threads': threads, 'pattern': os.path.join(out, 'aoi', 'yymmdd-name.tiff')})
+            seconds = time.perf_counter() - t
+            files = {}
+            for directory, _, filenames in os.walk(out):
+                for filename in filenames:
+                    with open(os.path.join(directory, filename), 'rb') as f:
+                        files[os.path.relpath(os.path.join(directory, filename), out)] = f.read()
+            outputs[name] = files
+            print(f"{name:>16}{seconds:9.2f}{stac.requests:10d}{server.requests:14d}{server.bytes_sent/1024**2:8.1f}{len(files):7d}")
+            server.shutdown()
+            stac.shutdown()
+        print("same files" if outputs['one run per AOI'] == outputs['batch mode'] else "DIFFERENT files")
+
+# Peak resident memory in MiB of this process or, on Linux, the one with `pid`
+def peak_rss(pid=None):
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open('/proc/%d/status' % pid) as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+
+class QuietHandler(sw.S):
+    def log_message(self, format, *args):
+        pass
+
+# Scripted jobs from order to download through the HTTP API of server-worker.py, with the front end, the job workers and
+# the CPU pool (as configured by the environment) running in this process, against synthetic scenes and a stub STAC
+# API served with some latency and bandwidth. Prints throughput, bytes, peak memory and the time per stage, and with
+# --json appends them (and the commit) to a file, so that they can be compared across commits.
+def bench_e2e(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        sw.start_cpu_pool()  # before any other threads exist
+        scenes = make_scenes(tmp, args.items, blocksize=args.blocksize)
+        server = start_server(tmp, KeepAliveRequestHandler, latency=args.latency, bandwidth=args.bandwidth * 1024**2 / 8,
+                              connections=multiprocessing.get_context('fork').Value('q', 0))
+        stac = start_server(None, StacHandler, latency=args.stac_latency, items=make_stac_items(scenes, server.url))
+        sw.STAC_URL = stac.url
+        sw.tile_cache = sw.TileCache(None, 0)  # measure the network, not the local cache
+        os.chdir(tmp)  # the jobs (and the job store) end up in ./jobs
+        os.makedirs('jobs')
+        logging.disable(logging.WARNING)
+        rss_before = peak_rss()
+
+        for i in range(args.workers):
+            Thread(target=sw.run_worker, daemon=True).start()
+        port = free_port()
+        Thread(target=sw.run_server, kwargs={'handler_class': QuietHandler, 'port': port}, daemon=True).start()
+        url = 'http://127.0.0.1:%d/' % port
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(url + 'api/queue/length').read()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+        def post(path, data):
+            request = urllib.request.Request(url + path, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'})
+            return json.load(urllib.request.urlopen(request))
+
+        # the jobs differ in AOI size, the AOIs of each job are offset a bit so that they don't share blocks
+        orders = {}  # jobname -> time of ordering
+        t = time.perf_counter()
+        for i in range(args.jobs):
+            aoi = args.aoi[i % len(args.aoi)]
+            x1, y1, x2, y2 = make_bbox(aoi)
+            shift = (1 - aoi) * (x2 - x1) * (i / args.jobs - 0.5) / 2
+            data = {'bbox': [x1 + shift, y1, x2 + shift, y2], 'start': '2024-03-05', 'end': '2024-03-31', 'max_cloud_cover': args.max_cloud_cover,
+                    'bands': ['blue', 'green', 'red', 'nir', 'swir16'], 'indices': ['ndvi', 'evi', 'ndre', 'msi'], 'other': ['tci'],
+                    'pattern': 'yymmdd-tile-name.tiff'}
+            orders[post('api/order', data)['jobname']] = time.perf_counter()
+
+        finished, downloads, states = {}, [], {}
+        while len(finished) < len(orders):
+            for jobname in orders:
+                if jobname in finished:
+                    continue
+                status = json.load(urllib.request.urlopen(url + 'api/jobs/' + jobname))
+                if status['ready'] or status['failed']:
+                    finished[jobname] = time.perf_counter()
+                    states[jobname] = 'failed' if status['failed'] else 'finished'
+                    if status['ready']:
+                        d = time.perf_counter()
+                        nbytes = len(urllib.request.urlopen(url + 'download/' + jobname + '.zip').read())
+                        downloads.append((nbytes, time.perf_counter() - d))
+            time.sleep(0.1)
+        seconds = max(finished.values()) - t
+
+        stages, scenes_processed = {}, 0
+        for jobname in orders:
+            if states[jobname] == 'finished':
+                with open(os.path.join('jobs', jobname, jobname + '.report.json')) as f:
+                    report = json.load(f)
+                scenes_processed += report['scenes_processed']
+                for stage, totals in report['stages'].items():
+                    stages[stage] = stages.get(stage, 0) + totals['seconds']
+        latencies = sorted(finished[jobname] - orders[jobname] for jobname in orders)
+        results = {
+            'seconds': seconds,
+            'jobs_finished': list(states.values()).count('finished'),
+            'scenes_processed': scenes_processed,
+            'scenes_per_second': scenes_processed / seconds,
+            'job_seconds_median': latencies[len(latencies) // 2],
+            'job_seconds_max': latencies[-1],
+            'cog_requests': server.requests,
+            'cog_mib': server.bytes_sent / 1024**2,
+            'stac_requests': stac.requests,
+            'download_mib_per_second': sum(nbytes for nbytes, _ in downloads) / 1024**2 / max(sum(s for _, s in downloads), 1e-9),
+            'peak_rss_mib': peak_rss(),
+            'rss_before_jobs_mib': rss_before,
+            'peak_rss_cpu_pool_mib': max([peak_rss(pid) for pid in sw.cpu_pool._processes] if sw.cpu_pool else [0]),
+            'stage_seconds': stages,
+        }
+        server.shutdown()
+        stac.shutdown()
+        if sw.cpu_pool:
+            sw.cpu_pool.shutdown()
+
+        bandwidth = f"{args.bandwidth:.0f} Mbit/s" if args.bandwidth else "unlimited bandwidth"
+        print(f"{args.jobs} jobs on {args.items} scenes, AOIs {', '.join('%.0f%%' % (aoi*100) for aoi in args.aoi)} of the scene, "
+              + f"{args.latency*1000:.0f} ms latency per request, {bandwidth}, {args.workers} job workers, {sw.CPU_WORKERS} CPU workers")
+        print(f"jobs:       {results['jobs_finished']}/{args.jobs} finished in {seconds:.2f} s, {scenes_processed} scenes processed "
+              + f"({results['scenes_per_second']:.2f} per second), from order to ready {results['job_seconds_median']:.2f} s median, {results['job_seconds_max']:.2f} s max")
+        print(f"fetched:    {results['cog_requests']} COG requests, {results['cog_mib']:.1f} MiB, {results['stac_requests']} STAC requests")
+        print(f"downloads:  {results['download_mib_per_second']:.1f} MiB/s from /download")
+        print(f"memory:     {results['peak_rss_mib']:.0f} MiB peak RSS ({rss_before:.0f} MiB before the jobs), {results['peak_rss_cpu_pool_mib']:.0f} MiB per CPU worker")
+        print("stages (seconds summed over all threads and jobs):")
+        for stage, stage_seconds in sorted(stages.items(), key=lambda entry: -entry[1]):
+            print(f"  {stage:>14} {stage_seconds:9.2f}")
+
+        if args.json:
+            try:
+                commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+            except OSError:
+                commit = None
+            settings = {key: value for key, value in vars(args).items() if key not in ['func', 'json']}
+            with open(args.json, 'a') as f:
+                f.write(json.dumps({'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings': settings, 'cpu_workers': sw.CPU_WORKERS, **results}) + '\n')
+
+# A build of the web GUI like the one of `npm run build` (index.html, a hashed JS bundle and stylesheet and an icon),
+# the bundle made of the sources of this repository to have the size of one that includes Vue
+def make_ui_build(directory, bundle_size=150000):
+    os.makedirs(os.path.join(directory, 'assets'))
+    with open('ui/src/App.vue') as f:
+        source = f.read()
+    code = ''
+    for filename in ['ui/src/App.vue', 'server-worker.py', 'benchmark.py', 's2-batch-download.py']:
+        with open(filename) as f:
+            code += f.read()
+    files = {
+        'index.html': '<!DOCTYPE html>\n<html lang="en">\n  <head>\n    <meta charset="UTF-8">\n    <link rel="icon" href="/favicon.ico">\n'
+                      + '    <title>HSNB Sentinel-2 Data Downloader</title>\n    <script type="module" crossorigin src="/assets/index-5f3a9c1e.js"></script>\n'
+                      + '    <link rel="stylesheet" href="/assets/index-8b2d4e07.css">\n  </head>\n  <body>\n    <div id="app"></div>\n  </body>\n</html>\n',
+        'assets/index-5f3a9c1e.js': '/* ' + (code * (bundle_size // len(code) + 1))[:bundle_size].replace('*/', '* /') + ' */\n',
+        'assets/index-8b2d4e07.css': source[source.index('<style'):] * 4,
+    }
+    for name, content in files.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(content)
+    with open(os.path.join(directory, 'favicon.ico'), 'wb') as f:
+        f.write(np.random.default_rng(0).integers(0, 256, 4286, dtype=np.uint8).tobytes())  # icons don't compress much
+    return ['/', '/favicon.ico'] + ['/' + name for name in files if name.startswith('assets/')]
+
+# Page loads of the web GUI by a browser that neither caches nor accepts compression (i.e. gets what the former file
+# serving sent every time) vs. a browser that does both, on its first and on later visits
+def bench_ui(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_ui_build(tmp)
+        sw.ui_files = sw.StaticFiles(tmp)
+        sw.ui_files.load()
+        process, url = start_frontend(ThreadingHTTPServer, 'http://127.0.0.1:9/')
+
+        def load_page(cache, accept_encoding):
+            requests, nbytes = 0, 0
+            for path in paths:
+                cached = cache.get(path)
+                if cached is not None and 'immutable' in cached['Cache-Control']:
+                    continue  # still fresh, the browser doesn't ask
+                headers = {'Accept-Encoding': accept_encoding}
+                if cached is not None:
+                    headers['If-None-Match'] = cached['ETag']
+                try:
+                    with urllib.request.urlopen(urllib.request.Request(url + path[1:], headers=headers)) as response:
+                        body = response.read()
+                        status, response_headers = response.status, response.headers
+                except urllib.error.HTTPError as e:
+                    body, status, response_headers = e.read(), e.code, e.headers
+                requests += 1
+                nbytes += len(body) + len(str(response_headers))
+                if status == 200 and response_headers['ETag'] and accept_encoding != 'identity':  # the no-cache browser
+                    cache[path] = response_headers
+                elif status not in [200, 304]:
+                    raise RuntimeError('%s: %d' % (path, status))
+            return requests, nbytes
+
+        print(f"web GUI of {len(paths)} files, {sum(len(f['variants']['identity']) for path, f in sw.ui_files.files.items() if path != '/index.html') / 1024:.0f} KiB, "
+              + f"{args.loads} page loads each, compressed variants: {', '.join(sorted({e for f in sw.ui_files.files.values() for e in f['variants']} - {'identity'}))}")
+        print(f"{'':>24}{'requests':>10}{'KiB':>9}{'ms':>8}   (per page load)")
+        for name, accept_encoding, warm in [('no cache, identity', 'identity', False), ('first visit, gzip, br', 'gzip, deflate, br', False),
+                                            ('repeat visit', 'gzip, deflate, br', True)]:
+            warm_cache = {}
+            if warm:
+                load_page(warm_cache, accept_encoding)
+            requests, nbytes = 0, 0
+            t = time.perf_counter()
+            for _ in range(args.loads):
+                r, n = load_page(dict(warm_cache), accept_encoding)
+                requests += r
+                nbytes += n
+            seconds = time.perf_counter() - t
+            print(f"{name:>24}{requests/args.loads:10.1f}{nbytes/args.loads/1024:9.1f}{seconds/args.loads*1000:8.2f}")
+        process.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(required=True)
+
+    download = subparsers.add_parser('download', help='sequential vs. concurrent band downloads')
+    download.add_argument('--items', type=int, default=4)
+    download.add_argument('--latency', type=float, default=0.05, help='seconds added to every HTTP request')
+    download.set_defaults(func=bench_download)
+
+    blocks = subparsers.add_parser('blocks', help='blocks downloaded vs. taken from the tile cache for overlapping windows')
+    blocks.set_defaults(func=bench_blocks)
+
+    indices = subparsers.add_parser('indices', help='index engine vs. the former float64 formulas')
+    indices.add_argument('--size', type=int, default=2000, help='edge length of the AOI in 10 m pixels')
+    indices.add_argument('--resampling', default='nearest', choices=['nearest', 'bilinear', 'average'], help='how the engine resamples 20 m bands')
+    indices.set_defaults(func=bench_indices)
+
+    server = subparsers.add_parser('server', help='latencies of the HTTP front end while searches are running')
+    server.add_argument('--clients', type=int, default=16)
+    server.add_argument('--checkers', type=int, default=2, help='how many of the clients run searches')
+    server.add_argument('--stac-latency', type=float, default=2, help='seconds the stub STAC API takes per request')
+    server.add_argument('--duration', type=float, default=10, help='seconds')
+    server.set_defaults(func=bench_server)
+
+    clouds = subparsers.add_parser('clouds', help='I/O of the staged cloud filter vs. full resolution SCL reads')
+    clouds.add_argument('--items', type=int, default=20)
+    clouds.add_argument('--aoi', type=float, default=0.8, help='size of the AOI relative to the scene')
+    clouds.add_argument('--max-cloud-cover', type=int, default=50)
+    clouds.add_argument('--latency', type=float, default=0.05, help='seconds added to every HTTP request')
+    clouds.set_defaults(func=bench_clouds)
+
+    tiled = subparsers.add_parser('tiled', help='peak memory of whole-array vs. tiled processing of growing AOIs')
+    tiled.add_argument('--aoi', type=float, nargs='+', default=[0.25, 0.5, 1], help='sizes of the AOI relative to the scene')
+    tiled.add_argument('--tile-blocks', type=int, default=1, help='edge length of the tiles in internal blocks')
+    tiled.set_defaults(func=bench_tiled)
+
+    outputs = subparsers.add_parser('outputs', help='size and write time of the output profiles')
+    outputs.add_argument('--size', type=int, default=2000, help='edge length of the AOI in 10 m pixels')
+    outputs.add_argument('--noise', type=int, default=30, help='DN of random noise added to the bands')
+    outputs.set_defaults(func=bench_outputs)
+
+    datacube = subparsers.add_parser('datacube', help='ZIP archive of COGs vs. one NetCDF datacube for a whole job')
+    datacube.add_argument('--items', type=int, default=6)
+    datacube.add_argument('--aoi', type=float, default=0.5, help='size of the AOI relative to the scene')
+    datacube.set_defaults(func=bench_datacube)
+
+    flaky = subparsers.add_parser('flaky', help='retries and partial failures against a fault-injecting server')
+    flaky.add_argument('--items', type=int, default=6)
+    flaky.add_argument('--aoi', type=float, default=0.5, help='size of the AOI relative to the scene')
+    flaky.add_argument('--failure-rate', type=float, default=0.1, help='share of requests answered with 503')
+    flaky.add_argument('--stall-rate', type=float, default=0.02, help='share of requests that hang for longer than the timeout')
+    flaky.add_argument('--timeout', type=int, default=2, help='GDAL_HTTP_TIMEOUT in seconds')
+    flaky.add_argument('--backoff', type=float, default=0.2, help='READ_BACKOFF in seconds')
+    flaky.set_defaults(func=bench_flaky)
+
+    gdal = subparsers.add_parser('gdal', help='HTTP requests per band read without vs. with the GDAL options')
+    gdal.add_argument('--items', type=int, default=4)
+    gdal.add_argument('--aoi', type=float, default=0.5, help='size of the AOI relative to the scene')
+    gdal.add_argument('--latency', type=float, default=0.02, help='seconds added to every HTTP request')
+    gdal.set_defaults(func=bench_gdal)
+
+    cpu = subparsers.add_parser('cpu', help='outputs computed in the job thread vs. in the CPU pool')
+    cpu.add_argument('--items', type=int, default=8)
+    cpu.add_argument('--aoi', type=float, default=0.8, help='size of the AOI relative to the scene')
+    cpu.add_argument('--workers', type=int, default=os.cpu_count(), help='CPU_WORKERS')
+    cpu.add_argument('--latency', type=float, default=0.02, help='seconds added to every HTTP request')
+    cpu.set_defaults(func=bench_cpu)
+
+    batch = subparsers.add_parser('batch', help='s2-batch-download.py with one run per AOI vs. batch mode')
+    batch.add_argument('--plots', type=int, default=50, help='number of AOIs')
+    batch.add_argument('--plot-size', type=float, default=200, help='edge length of the AOIs in metres')
+    batch.add_argument('--items', type=int, default=4)
+    batch.add_argument('--threads', type=int, default=16, help='`threads` of the batch mode')
+    batch.add_argument('--latency', type=float, default=0.02, help='seconds added to every HTTP request')
+    batch.set_defaults(func=bench_batch)
+
+    e2e = subparsers.add_parser('e2e', help='scripted jobs from order to download through the HTTP API')
+    e2e.add_argument('--jobs', type=int, default=4)
+    e2e.add_argument('--items', type=int, default=6, help='scenes found by every job')
+    e2e.add_argument('--aoi', type=float, nargs='+', default=[0.3, 0.6], help='sizes of the AOIs relative to the scene, one per job in turn')
+    e2e.add_argument('--max-cloud-cover', type=int, default=60)
+    e2e.add_argument('--blocksize', type=int, default=1024, help='internal blocks of the COGs, 1024 like the Sentinel-2 COGs on AWS')
+    e2e.add_argument('--latency', type=float, default=0.02, help='seconds added to every HTTP request')
+    e2e.add_argument('--bandwidth', type=float, default=200, help='Mbit/s of the link to the COG server (0 = unlimited)')
+    e2e.add_argument('--stac-latency', type=float, default=0.2, help='seconds the stub STAC API takes per request')
+    e2e.add_argument('--workers', type=int, default=sw.JOB_WORKERS, help='JOB_WORKERS')
+    e2e.add_argument('--json', help='file to append the results to (one JSON object per line)')
+    e2e.set_defaults(func=bench_e2e)
+
+    ui = subparsers.add_parser('ui', help='requests and bytes per page load of the web GUI without vs. with caching and compression')
+    ui.add_argument('--loads', type=int, default=200)
+    ui.set_defaults(func=bench_ui)
+
+    args = parser.parse_args()
+    args.func(args)
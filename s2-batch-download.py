@@ -5,7 +5,14 @@ end   = '2024-03-23'  # format: YYYY-MM-DD
 # band number to name mappings: 1=coastal, 2=blue, 3=green, 4=red, 5=rededge1, 6=rededge2, 7=rededge3, 8=nir, 8a=nir08, 9=nir09, 11=swir16, 12=swir22
 bands = ['coastal', 'blue', 'green', 'red', 'rededge1', 'rededge2', 'rededge3', 'nir', 'nir08', 'nir09', 'swir16', 'swir22']
 indices = ['ndvi']  # not implemented yet
-pattern = 'out/yymmdd-name.tiff'  # any folder structure must exist
+pattern = 'out/yymmdd-name.tiff'  # missing folders are created
+# batch mode: instead of `bbox`, all AOIs in this file are downloaded (in one go, which is a lot faster than one run per AOI)
+# either a GeoJSON FeatureCollection (each feature's bbox is used, its name is the "name" or "id" property or else its position)
+# or a CSV file with the columns name,xmin,ymin,xmax,ymax
+# "aoi" in `pattern` is replaced by the AOI's name, e.g. 'out/aoi/yymmdd-name.tiff' (without it, it's put in front of the file names)
+aois = None  # e.g. 'plots.geojson'
+# "tile" in `pattern` is replaced by the MGRS tile, e.g. 33UUV, without it only one tile per AOI and day is downloaded
+threads = 16  # number of COGs that are read at the same time
 
 # STOP
 # Edit until here and run code once
@@ -14,29 +21,74 @@ download = False   # Please leave it on False for the first run to see how many
 
 # STOP STOP
 
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import rasterio
 from rasterio.warp import transform_bounds
 import numpy as np
 from pystac_client import Client as stac
 
+# saves the parts of the COG at `url` that cover each bbox in `subsets` (a list of (bbox_4326, filename) tuples), the
+# COG is opened only once for all of them. Parts outside of the COG are filled with 0.
+def save_cog_subsets(url, subsets):
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'), rasterio.open(url) as src:  # no looking for sidecar files, which saves about ten requests
+        for bbox_4326, filename in subsets:
+            bounds = transform_bounds(4326, src.crs.to_epsg(), *bbox_4326)
+            window = rasterio.windows.from_bounds(*bounds, src.transform)
+            inside = window.col_off >= 0 and window.row_off >= 0 and window.col_off + window.width <= src.width and window.row_off + window.height <= src.height
+            chunk = src.read(1, window=window, boundless=not inside, fill_value=0)
+
+            if os.path.dirname(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with rasterio.open(
+                filename,
+                'w',
+                driver='GTiff',
+                width=chunk.shape[1],
+                height=chunk.shape[0],
+                count=1,
+                dtype=chunk.dtype,
+                crs=src.crs,
+                transform=src.window_transform(window)
+            ) as dst:
+                dst.write(chunk, indexes=1)
+            print(filename)
+
 def save_cog_subset(url, bbox_4326, filename):
-    with rasterio.open(url) as src:
-        bounds = transform_bounds(4326, src.crs.to_epsg(), *bbox_4326)
-        window = rasterio.windows.from_bounds(*bounds, src.transform)
-        chunk = src.read(1, window=window)
-
-        with rasterio.open(
-            filename,
-            'w',
-            driver='GTiff',
-            width=chunk.shape[1],
-            height=chunk.shape[0],
-            count=1,
-            dtype=chunk.dtype,
-            crs=src.crs,
-            transform=src.window_transform(window)
-        ) as dst:
-            dst.write(chunk, indexes=1)
+    save_cog_subsets(url, [(bbox_4326, filename)])
+
+# returns (name, bbox) tuples of the AOIs in a GeoJSON or CSV file, see `aois` above
+def read_aois(filename):
+    if filename.lower().endswith('.csv'):
+        with open(filename, newline='') as f:
+            return [(row['name'], [float(row[key]) for key in ['xmin', 'ymin', 'xmax', 'ymax']]) for row in csv.DictReader(f)]
+    with open(filename) as f:
+        features = json.load(f)['features']
+    result = []
+    for i, feature in enumerate(features):
+        bbox = feature.get('bbox')
+        if bbox is None:
+            points = np.array(list(flatten_coordinates(feature['geometry']['coordinates'])))
+            bbox = [*points.min(axis=0)[:2], *points.max(axis=0)[:2]]
+        properties = feature.get('properties') or {}
+        result.append((str(properties.get('name', feature.get('id', i))), [float(x) for x in bbox]))
+    return result
+
+def flatten_coordinates(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for part in coordinates:
+            yield from flatten_coordinates(part)
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+def intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
 
 # example:
 #url = 'https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/33/U/UV/2023/7/S2A_33UUV_20230715_0_L2A/B02.tif'
@@ -49,28 +101,59 @@ ALL_ASSETS_ALPHABETICAL = ['aot', 'blue', 'coastal', 'granule_metadata', 'green'
 ALL_BANDS_IN_ORDER = ['coastal', 'blue', 'green', 'red', 'rededge1', 'rededge2', 'rededge3', 'nir', 'nir08', 'nir09', 'swir16', 'swir22']
 # assets that are not included in ALL_BANDS_IN_ORDER: 'aot', 'granule_metadata', 'scl', 'thumbnail', 'tileinfo_metadata', 'visual', 'wvp'
 
-catalog = stac.open("https://earth-search.aws.element84.com/v1")
+aoi_list = read_aois(aois) if aois else [('aoi', bbox)]
+if aois:
+    # otherwise the AOIs would overwrite each other's files
+    duplicates = sorted({name for name, _ in aoi_list if [n for n, _ in aoi_list].count(name) > 1})
+    if duplicates:
+        raise SystemExit("The names of the AOIs in " + aois + " must be unique, but these occur more than once: " + ", ".join(duplicates))
+    if 'aoi' not in pattern:
+        pattern = os.path.join(os.path.dirname(pattern), 'aoi-' + os.path.basename(pattern))
+        print(f"There's no \"aoi\" in `pattern`, using {pattern} instead")
+
+# one search for all AOIs, they are given as a MultiPolygon so that only scenes that cover any of them are found
+catalog = stac.open(os.environ.get('STAC_URL', "https://earth-search.aws.element84.com/v1"))
 search = catalog.search(
     max_items = None,
     collections = ['sentinel-2-l2a'],
-    bbox = bbox,
+    intersects = {'type': 'MultiPolygon', 'coordinates': [[[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]] for _, (x1, y1, x2, y2) in aoi_list]},
     datetime = [start+'T00:00:00Z', end+'T00:00:00Z'],
 )
 
-item_count = search.matched()
+# then which AOI is downloaded from which item: all items that cover it, or if there's no "tile" in the pattern, only
+# one per day (preferably one that covers it completely)
+items = list(search.items())
+subsets = []  # (item, aoi name, aoi bbox) tuples
+for name, aoi_bbox in aoi_list:
+    candidates = sorted([item for item in items if intersects(item.bbox, aoi_bbox)], key=lambda item: (not contains(item.bbox, aoi_bbox), item.id))
+    days = set()
+    for item in candidates:
+        if 'tile' in pattern or item.datetime.date() not in days:
+            days.add(item.datetime.date())
+            subsets.append((item, name, aoi_bbox))
+
+item_count = len(items)
 files_per_item = len(bands) + len(indices)
 print(f"Your search matched {item_count} items")
-print(f"You requested {len(bands)} bands and {len(indices)} indices, i.e. {files_per_item} files per item")
-print(f"That means you will download {item_count*files_per_item} files in total")
+if aois:
+    print(f"They cover your {len(aoi_list)} AOIs {len(subsets)} times")
+print(f"You requested {len(bands)} bands and {len(indices)} indices, i.e. {files_per_item} files per item" + (" and AOI" if aois else ""))
+print(f"That means you will download {len(subsets)*files_per_item} files in total")
 
 if not download:
     print("If you're sure you want to continue, set the 'download' variable to 'True' and run this script again")
 
 else:
 
-    for item in search.items():
+    # each COG is read by one thread, which saves the windows of all AOIs in it
+    tasks = {}  # asset url -> list of (bbox, filename) tuples
+    for item, name, aoi_bbox in subsets:
         yymmdd = str(item.datetime)[2:10].replace('-', '')
+        tile = str(item.properties['mgrs:utm_zone']) + item.properties['mgrs:latitude_band'] + item.properties['mgrs:grid_square']
         for band in bands:
-            filename = pattern.replace('name', band).replace('yymmdd', yymmdd)
-            print(filename)
-            save_cog_subset(item.assets[band].href, bbox, filename)
\ No newline at end of file
+            filename = pattern.replace('name', band).replace('yymmdd', yymmdd).replace('tile', tile).replace('aoi', name)
+            tasks.setdefault(item.assets[band].href, []).append((aoi_bbox, filename))
+
+    with ThreadPoolExecutor(threads) as pool:
+        for result in pool.map(lambda task: save_cog_subsets(*task), tasks.items()):
+            pass  # re-raises errors
\ No newline at end of file
@@ -4,15 +4,18 @@ Author: Christoph Friedrich <christoph.friedrich@uni-wuerzburg.de>
 Usage: python3 server-worker.py
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
 
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
 
 import queue
-q = queue.Queue()
-current_job = None
-percentage = None
+q = queue.PriorityQueue()  # contains (virtual deadline, jobname) tuples, see `submit_job`
+jobs = {}  # jobname -> {'data': ..., 'state': 'queued'/'processing'/'finished', 'percentage': ..., ...}
+jobs_lock = Lock()
 
 import json
 
@@ -25,108 +28,1015 @@ import os
 from datetime import datetime
 
 import rasterio
-from rasterio.warp import transform_bounds
+import rasterio._base  # for `VSICurlPartialClearCache`
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window
+from affine import Affine
 import numpy as np
 from pystac_client import Client as stac
 
-import shutil
+import zipfile
+import zlib
+import gzip
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+import sqlite3
+import hashlib
+import math
+import random
+import re
+import time
+import contextvars
+import ctypes
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+try:
+    import netCDF4  # optional, only needed for jobs with "output_format": "netcdf"
+except ImportError:
+    netCDF4 = None
+try:
+    import brotli  # optional, without it the web GUI is only sent gzip-compressed
+except ImportError:
+    brotli = None
+
+# COG range reads are latency-bound, so many of them are kept in flight at once
+# (DOWNLOAD_THREADS in total and at most DOWNLOAD_THREADS_PER_HOST towards the same host)
+DOWNLOAD_THREADS = int(os.environ.get('DOWNLOAD_THREADS', 32))
+DOWNLOAD_THREADS_PER_HOST = int(os.environ.get('DOWNLOAD_THREADS_PER_HOST', 16))
+download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS, thread_name_prefix='download')
+host_semaphores = {}
+host_semaphores_lock = Lock()
+
+# COG reads that fail for reasons that may go away (HTTP 5xx, 408 and 429, timeouts, broken connections) are retried up
+# to READ_RETRIES times, after waiting a random time of up to READ_BACKOFF * 2^n seconds (at most READ_BACKOFF_MAX)
+# before the n-th retry, see `with_retries`. The timeouts of single requests are GDAL_HTTP_TIMEOUT and
+# GDAL_HTTP_CONNECTTIMEOUT (seconds) in GDAL_OPTIONS.
+READ_RETRIES = int(os.environ.get('READ_RETRIES', 5))
+READ_BACKOFF = float(os.environ.get('READ_BACKOFF', 1))
+READ_BACKOFF_MAX = float(os.environ.get('READ_BACKOFF_MAX', 30))
+
+# GDAL options that all reads of COGs happen with (see `gdal_env` and https://gdal.org/user/configoptions.html), each
+# one can be overridden by an environment variable of the same name. Other GDAL options (e.g. GDAL_CACHEMAX or proxies)
+# can be set as environment variables as usual. Without these, opening a COG costs about ten extra requests because
+# GDAL looks for a directory listing and sidecar files (.aux.xml, .msk, ...) next to it.
+GDAL_OPTIONS = {name: os.environ.get(name, default) for name, default in {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',  # no directory listings and no probing for sidecar files
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.tiff',  # and nothing else that isn't a COG
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',  # adjacent blocks in one request
+    'GDAL_HTTP_MULTIRANGE': 'YES',  # blocks that aren't adjacent in parallel requests
+    'GDAL_HTTP_VERSION': '2TLS',  # HTTP/2 where the server offers it, so requests to the same host share a connection
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_TCP_KEEPALIVE': 'YES',  # connections are reused by later reads from the same thread
+    'CPL_VSIL_CURL_CACHE_SIZE': str(128 * 1024**2),  # bytes of downloaded ranges shared by all threads, mostly so that
+                                                      # headers are still there when a COG is opened again
+    'GDAL_HTTP_TIMEOUT': '30',
+    'GDAL_HTTP_CONNECTTIMEOUT': '10',
+}.items()}
+
+# Number of jobs that are processed at the same time (each one in its own worker thread, all sharing the download pool)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 1))
+# Number of scenes whose bands are downloaded ahead of the one being processed (they are held in memory), per job and
+# in total over all jobs. A job always gets the scene it is at, so the total only limits how far ahead jobs get.
+PREFETCH_ITEMS = int(os.environ.get('PREFETCH_ITEMS', 8))
+PREFETCH_ITEMS_TOTAL = int(os.environ.get('PREFETCH_ITEMS_TOTAL', 16))
+prefetch_slots = BoundedSemaphore(max(1, PREFETCH_ITEMS_TOTAL))
+# Number of processes that compute the outputs of scenes (indices, composites and encoding the GeoTIFFs) once their
+# bands are downloaded, see `process_shared_scene`, so that jobs use all cores while their next scenes are downloaded.
+# At most CPU_QUEUE scenes are waiting for or being processed by them at any time (their bands are held in shared
+# memory until they are done). With 0 processes, the outputs are computed in the job's worker thread.
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', os.cpu_count() or 1))
+CPU_QUEUE = int(os.environ.get('CPU_QUEUE', 2 * CPU_WORKERS))
+cpu_pool = None  # see `start_cpu_pool`
+cpu_pool_lock = Lock()  # for replacing a broken pool, see `restart_cpu_pool`
+cpu_slots = BoundedSemaphore(max(1, CPU_QUEUE))
+# Cloud filter stages, see `filter_cloudy_items`
+SCENE_CLOUD_COVER_REJECT = float(os.environ.get('SCENE_CLOUD_COVER_REJECT', 99))
+SCL_OVERVIEW_LEVEL = int(os.environ.get('SCL_OVERVIEW_LEVEL', 1))  # 0 = first overview (40 m for SCL), negative to skip this stage
+SCL_BORDERLINE_MARGIN = float(os.environ.get('SCL_BORDERLINE_MARGIN', 0.1))
+# AOIs with more pixels than this (on the finest grid needed) are processed tile by tile instead of as whole arrays, see
+# `process_item_tiled`. The tiles are TILE_BLOCKS x TILE_BLOCKS internal blocks of the COGs.
+TILED_MODE_PIXELS = int(os.environ.get('TILED_MODE_PIXELS', 25_000_000))
+TILE_BLOCKS = int(os.environ.get('TILE_BLOCKS', 1))
+# Data type that indices are computed and stored in
+INDEX_DTYPE = os.environ.get('INDEX_DTYPE', 'float32')
+# Format of the output files of jobs that don't ask for one, see OUTPUT_PROFILES
+OUTPUT_PROFILE = os.environ.get('OUTPUT_PROFILE', 'cog-deflate')
+# Largest error allowed when indices are stored with the 'cog-lerc' profile
+LERC_MAX_Z_ERROR = float(os.environ.get('LERC_MAX_Z_ERROR', 0.0001))
+# Edge length in pixels of the chunks of NetCDF datacubes (each chunk holds one time step), see `Datacube`
+DATACUBE_CHUNK_SIZE = int(os.environ.get('DATACUBE_CHUNK_SIZE', 512))
+# Rough guess of how long one output file takes, only used to order the queue (see `submit_job`)
+SECONDS_PER_FILE_ESTIMATE = float(os.environ.get('SECONDS_PER_FILE_ESTIMATE', 2))
+
+# STAC API to search for Sentinel-2 scenes. Searches run in their own small pool, so a slow catalog can't tie up more
+# than STAC_THREADS threads and requests give up after STAC_TIMEOUT seconds
+STAC_URL = os.environ.get('STAC_URL', 'https://earth-search.aws.element84.com/v1')
+STAC_THREADS = int(os.environ.get('STAC_THREADS', 4))
+STAC_TIMEOUT = float(os.environ.get('STAC_TIMEOUT', 60))
+stac_pool = ThreadPoolExecutor(max_workers=STAC_THREADS, thread_name_prefix='stac')
+STAC_COLLECTION = 'sentinel-2-l2a'
+# Search results are reused for this many seconds (e.g. between /api/check, /api/order and the worker)
+SEARCH_CACHE_TTL = float(os.environ.get('SEARCH_CACHE_TTL', 600))
+catalog = None
+catalog_lock = Lock()
+search_cache = {}  # (bbox, start, end, collection) -> (time of the search, Future of the list of items)
+search_cache_lock = Lock()
+
+# SQLite database in which the queue and the progress of jobs are kept, so that unfinished jobs are resumed after a
+# restart, see `JobStore`
+JOB_STORE = os.environ.get('JOB_STORE', './jobs/jobs.sqlite')
+
+# Local cache for the internal blocks of the remote COGs (0 disables it)
+CACHE_DIR = os.environ.get('CACHE_DIR', './cache')
+CACHE_MAX_GB = float(os.environ.get('CACHE_MAX_GB', 20))
 
 
 ###############################################################################
 
 
-def save_cog_subset(url, bbox_4326, filename):
-    with rasterio.open(url) as src:
-        bounds = transform_bounds(4326, src.crs.to_epsg(), *bbox_4326)
-        window = rasterio.windows.from_bounds(*bounds, src.transform)
-        chunk = src.read(1, window=window)
-
-        if filename is None:
-            return chunk
+# Time spent in (summed over all threads) and bytes moved by the stages of processing, either for the whole server
+# (`metrics`), a job or a single item of a job. The stages are 'search', 'cloud_filter', 'read' (COG range reads, the
+# bytes are decoded pixels), 'wait' (a job waiting for its reads), 'resample', 'index', 'composite', 'write' (encoding
+# GeoTIFFs), 'cpu_wait' (a job waiting for the CPU pool) and 'archive' (adding them to the ZIP, the bytes are what ends
+# up in there).
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = {}  # stage -> {'seconds': ..., 'calls': ..., 'bytes': ...}
+        self.counters = {}  # e.g. 'blocks_cached', 'blocks_downloaded', 'scenes_processed'
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0, 'calls': 0, 'bytes': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += 1
+            totals['bytes'] += nbytes
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def as_dict(self):
+        with self.lock:
+            return {'stages': {stage: dict(totals) for stage, totals in self.stages.items()}, 'counters': dict(self.counters)}
+
+    # Adds up the numbers of `other`, the `as_dict` of another Stats (e.g. one from a process of the CPU pool)
+    def add(self, other):
+        with self.lock:
+            for stage, totals in other['stages'].items():
+                mine = self.stages.setdefault(stage, {'seconds': 0, 'calls': 0, 'bytes': 0})
+                for key in mine:
+                    mine[key] += totals[key]
+            for counter, n in other['counters'].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+
+metrics = Stats()
+# The Stats of the job (and item) that the current thread works for, in addition to `metrics`. Work for a job that's
+# done in the download pool has to be submitted via `submit_download` to be accounted to it.
+current_stats = contextvars.ContextVar('current_stats', default=())
+
+def record_stage(stage, seconds, nbytes=0):
+    for stats in (metrics, *current_stats.get()):
+        stats.record(stage, seconds, nbytes)
+
+def count(counter, n=1):
+    for stats in (metrics, *current_stats.get()):
+        stats.count(counter, n)
+
+def add_stats(other):
+    for stats in (metrics, *current_stats.get()):
+        stats.add(other)
+
+# Records the time spent in the `with` block as `stage`, bytes can be added to the 'bytes' entry of the yielded dict
+@contextmanager
+def measure(stage):
+    measured = {'bytes': 0}
+    t = time.perf_counter()
+    try:
+        yield measured
+    finally:
+        record_stage(stage, time.perf_counter() - t, measured['bytes'])
+
+# `download_pool.submit`, but the function's work is accounted to `stats` (by default the ones of the calling thread)
+def submit_download(function, *args, stats=None):
+    context = contextvars.copy_context()
+    if stats is not None:
+        context.run(current_stats.set, stats)
+    return download_pool.submit(context.run, function, *args)
+
+# Content-addressed on-disk cache with LRU eviction. The keys are hashes of whatever identifies the content (e.g. asset
+# href, overview level and block position), the values are stored as one file per key. The least recently used entries
+# are evicted as soon as the total size exceeds `max_bytes`. File modification times serve as "last used" timestamps,
+# so the LRU order survives restarts.
+class TileCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        if not self.enabled:
+            return
+        os.makedirs(directory, exist_ok=True)
+        found = []
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):  # leftover of an interrupted write
+                    os.remove(os.path.join(dirpath, filename))
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                found.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(found):
+            self.entries[filename] = size
+            self.total_bytes += size
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(*parts, extension='.npy'):
+        return hashlib.sha256('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest() + extension
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_served += self.entries[key]
+        try:
+            os.utime(self.path(key))
+            if key.endswith('.json'):
+                with open(self.path(key), 'r') as f:
+                    return json.load(f)
+            return np.load(self.path(key))
+        except (OSError, ValueError):  # evicted by another thread in the meantime or damaged -> treat it as a miss
+            return None
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        tmp = self.path(key) + '.' + str(os.getpid()) + '-' + str(id(value)) + '.tmp'
+        if key.endswith('.json'):
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+        else:
+            with open(tmp, 'wb') as f:
+                np.save(f, value)
+        os.replace(tmp, self.path(key))  # atomic, so readers never see half-written files
+        size = os.path.getsize(self.path(key))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted, evicted_size = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+                try:
+                    os.remove(self.path(evicted))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+                'evictions': self.evictions,
+                'bytes_served': self.bytes_served,
+                'entries': len(self.entries),
+                'size_bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+tile_cache = TileCache(CACHE_DIR, int(CACHE_MAX_GB * 1024**3))
+
+# A read of `url` that failed for good (after retrying, if the error looked like it might go away). It's still a
+# RasterioIOError, so e.g. a missing overview is handled the same way as before.
+class ReadError(rasterio.errors.RasterioIOError):
+    def __init__(self, url, err):
+        super().__init__(url + ': ' + str(err))
+        self.url = url
+
+# Errors of GDAL (or rather curl) that may go away when trying again: server errors, timeouts and throttling, and
+# connections that couldn't be made or broke off. If the first range request of a remote COG fails, GDAL only says that
+# the file isn't in a supported format, so that counts as well for /vsicurl/ (but not for local files).
+TRANSIENT_ERRORS = re.compile(r'HTTP response code: (5\d\d|408|429)|timed out|Timeout was reached|Connection reset|Connection refused|'
+                              + r'Could not connect|Couldn\'t connect|Empty reply from server|Recv failure|Send failure|'
+                              + r"'/vsicurl/[^']*' not recognized as being in a supported file format", re.IGNORECASE)
+
+# Whether a failed read is worth retrying. Everything else (missing files, unsupported formats, corrupt TIFFs, client
+# errors, overviews that don't exist, ...) fails right away.
+def is_transient(err):
+    return TRANSIENT_ERRORS.search(str(err)) is not None
+
+# Environment with GDAL_OPTIONS (and `options` on top of them) for reading COGs, entered by the thread that reads
+def gdal_env(**options):
+    return rasterio.Env(**{**GDAL_OPTIONS, **options})
+
+# GDAL's function for dropping what it cached about some URLs, which rasterio doesn't wrap. It's looked up in the GDAL
+# library that rasterio is linked against (None if that fails, then retries may get GDAL's cached failure again).
+try:
+    VSICurlPartialClearCache = ctypes.CDLL(rasterio._base.__file__).VSICurlPartialClearCache
+    VSICurlPartialClearCache.argtypes = [ctypes.c_char_p]
+    VSICurlPartialClearCache.restype = None
+except (OSError, AttributeError):
+    VSICurlPartialClearCache = None
+
+# Makes GDAL forget the size, the failed requests and the downloaded ranges of `url` (if it's an HTTP URL)
+def clear_gdal_cache(url):
+    if VSICurlPartialClearCache is not None and urlparse(url).scheme in ['http', 'https']:
+        VSICurlPartialClearCache(('/vsicurl/' + url).encode('utf-8'))
+
+# Calls `read` (a function that reads from `url`) in `gdal_env` and retries it with jittered exponential backoff as configured by the
+# READ_* variables. The random waits keep threads that failed at the same time from retrying at the same time, and the
+# per-host semaphore stays taken while waiting, so an overloaded host gets fewer requests. GDAL remembers failed
+# requests, so that's cleared for `url` before retrying.
+def with_retries(url, read):
+    for attempt in range(READ_RETRIES + 1):
+        if attempt:
+            clear_gdal_cache(url)
+        try:
+            with gdal_env():
+                return read()
+        except rasterio.errors.RasterioIOError as err:
+            if attempt == READ_RETRIES or not is_transient(err):
+                count('read_failures')
+                raise ReadError(url, err) from err
+            delay = random.uniform(0, min(READ_BACKOFF_MAX, READ_BACKOFF * 2**attempt))
+            logging.warning("Reading %s failed (%s), retrying in %.1f s", url, err, delay)
+            count('read_retries')
+            time.sleep(delay)
+
+# Everything about a COG (or one of its overviews) that is needed to locate windows in it
+def get_cog_header(url, overview_level=None):
+    key = TileCache.make_key(url, overview_level, 'header', extension='.json')
+    header = tile_cache.get(key)
+    if header is None:
+        def read_header():
+            with rasterio.open(url, overview_level=overview_level) as src:
+                return {
+                    'crs': src.crs.to_wkt(),
+                    'epsg': src.crs.to_epsg(),
+                    'transform': list(src.transform)[:6],
+                    'width': src.width,
+                    'height': src.height,
+                    'dtype': src.dtypes[0],
+                    'nodata': src.nodata,
+                    'block_shape': list(src.block_shapes[0]),
+                }
+        with measure('read'):
+            header = with_retries(url, read_header)
+        tile_cache.put(key, header)
+    return header
+
+# Pixel window of the COG described by `header` that covers `bounds` (in the COG's CRS), snapped outwards to whole
+# pixels, grown by `margin` pixels on each side and clipped to `within` (by default the whole COG)
+def bounds_to_window(header, bounds, margin=0, within=None):
+    window = rasterio.windows.from_bounds(*bounds, Affine(*header['transform']))
+    within = within or Window(0, 0, header['width'], header['height'])
+    col_start = max(within.col_off, math.floor(window.col_off) - margin)
+    row_start = max(within.row_off, math.floor(window.row_off) - margin)
+    col_end = min(within.col_off + within.width, math.ceil(window.col_off + window.width) + margin)
+    row_end = min(within.row_off + within.height, math.ceil(window.row_off + window.height) + margin)
+    return Window(col_start, row_start, max(0, col_end-col_start), max(0, row_end-row_start))
+
+# Pixel window of the COG described by `header` that covers `bbox_4326`. Unless `clip` is set, it may extend beyond the
+# COG, which is what mosaics of several COGs are made on.
+def get_aoi_window(header, bbox_4326, clip=True):
+    unlimited = Window(-2**31, -2**31, 2**32, 2**32)
+    return bounds_to_window(header, transform_bounds(4326, header['epsg'], *bbox_4326), within=None if clip else unlimited)
+
+def window_metadata(header, window):
+    return Metadata(window.width, window.height, CRS.from_wkt(header['crs']), rasterio.windows.transform(window, Affine(*header['transform'])), header['nodata'])
+
+# Reads the part of a COG that covers `bbox_4326` and returns it together with its Metadata, see `read_cog_window`
+def read_cog_subset(url, bbox_4326, overview_level=None):
+    return read_cog_window(url, get_aoi_window(get_cog_header(url, overview_level), bbox_4326), overview_level)
+
+# Reads a pixel window of a COG and returns it together with its Metadata. The window is extended to whole internal
+# blocks, which are what gets cached. So overlapping or repeated requests only download the blocks that haven't been
+# seen before (or rather the smallest rectangle of blocks that has all of those).
+def read_cog_window(url, window, overview_level=None):
+    header = get_cog_header(url, overview_level)
+    metadata = window_metadata(header, window)
+    col_start, row_start = window.col_off, window.row_off
+    col_end, row_end = window.col_off + window.width, window.row_off + window.height
+
+    block_height, block_width = header['block_shape']
+    block_rows = range(row_start // block_height, (max(row_end, row_start+1)-1) // block_height + 1)
+    block_cols = range(col_start // block_width, (max(col_end, col_start+1)-1) // block_width + 1)
+    keys = {(r, c): TileCache.make_key(url, overview_level, r, c) for r in block_rows for c in block_cols}
+    blocks = {position: tile_cache.get(key) for position, key in keys.items()}
+
+    # block-aligned region that contains the requested window
+    region_col = block_cols[0] * block_width
+    region_row = block_rows[0] * block_height
+    region = Window(region_col, region_row,
+                    min(header['width'], (block_cols[-1]+1) * block_width) - region_col,
+                    min(header['height'], (block_rows[-1]+1) * block_height) - region_row)
+
+    missing = [position for position, block in blocks.items() if block is None]
+    if missing:  # fetch the smallest block-aligned window with all missing blocks in one go, GDAL merges the range requests
+        fetch_rows = range(min(r for r, _ in missing), max(r for r, _ in missing) + 1)
+        fetch_cols = range(min(c for _, c in missing), max(c for _, c in missing) + 1)
+        fetch_col, fetch_row = fetch_cols[0] * block_width, fetch_rows[0] * block_height
+        fetch = Window(fetch_col, fetch_row,
+                       min(header['width'], (fetch_cols[-1]+1) * block_width) - fetch_col,
+                       min(header['height'], (fetch_rows[-1]+1) * block_height) - fetch_row)
+        def read_missing():
+            with rasterio.open(url, overview_level=overview_level) as src:
+                return src.read(1, window=fetch)
+        with measure('read') as measured:
+            fetched = with_retries(url, read_missing)
+            measured['bytes'] = fetched.nbytes
+        count('blocks_downloaded', len(fetch_rows) * len(fetch_cols))
+        for r in fetch_rows:
+            for c in fetch_cols:
+                y = r * block_height - fetch_row
+                x = c * block_width - fetch_col
+                cached = blocks[(r, c)] is not None  # in between missing blocks, it came along anyway
+                blocks[(r, c)] = fetched[y:y+block_height, x:x+block_width]
+                if not cached:
+                    tile_cache.put(keys[(r, c)], blocks[(r, c)])
+    downloaded = len(fetch_rows) * len(fetch_cols) if missing else 0
+    if downloaded < len(keys):
+        count('blocks_cached', len(keys) - downloaded)
+
+    if missing and fetch == region:
+        data = fetched
+    else:  # put together from the blocks
+        data = np.empty((region.height, region.width), dtype=header['dtype'])
+        for (r, c), block in blocks.items():
+            y = r * block_height - region_row
+            x = c * block_width - region_col
+            data[y:y+block.shape[0], x:x+block.shape[1]] = block
+
+    chunk = data[row_start-region_row:row_end-region_row, col_start-region_col:col_end-region_col]
+    return chunk, metadata
 
-        with rasterio.open(
-            filename,
-            'w',
-            driver='GTiff',
-            width=chunk.shape[1],
-            height=chunk.shape[0],
-            count=1,
-            dtype=chunk.dtype,
-            crs=src.crs,
-            transform=src.window_transform(window)
-        ) as dst:
-            dst.write(chunk, indexes=1)
+def save_cog_subset(url, bbox_4326, filename):
+    chunk, metadata = read_cog_subset(url, bbox_4326)
+
+    if filename is None:
+        return chunk
+
+    with measure('write'):
+        save_as_tiff(chunk, metadata, filename)
+
+def get_host_semaphore(url):
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = BoundedSemaphore(DOWNLOAD_THREADS_PER_HOST)
+        return host_semaphores[host]
+
+# Same as `read_cog_subset` but respects the per-host limit, meant to be run in the `download_pool`
+def fetch_cog_subset(url, bbox_4326, overview_level=None):
+    with get_host_semaphore(url):
+        return read_cog_subset(url, bbox_4326, overview_level)
+
+# Same for `read_cog_window`
+def fetch_cog_window(url, window, overview_level=None):
+    with get_host_semaphore(url):
+        return read_cog_window(url, window, overview_level)
+
+# Several items of the same acquisition (datatake and day) cover an AOI that crosses MGRS tile borders. They are read
+# into one mosaic on the grid of the first one (see `group_items`), extended to the whole AOI. A single item is just
+# read as it is.
+def get_mosaic_grid(urls, bbox_4326, overview_level=None):
+    header = get_cog_header(urls[0], overview_level)
+    return header, get_aoi_window(header, bbox_4326, clip=len(urls) == 1)
+
+# Reads `window` of the grid described by `header` (see `get_mosaic_grid`) from all of `urls` and returns it together
+# with its Metadata. Only the part of each COG that covers the window is fetched, reprojected onto the grid with nearest
+# neighbour (which copies the pixels as they are if the grids are aligned, as they are for tiles in the same UTM zone)
+# and used where the mosaic has no data yet. Across UTM zones GDAL approximates the transformation (to 1/8 pixel), so
+# for pixels right at the edge of a source pixel the tiled mode may pick its neighbour instead.
+# Respects the per-host limit, meant to be run in the `download_pool`.
+def fetch_mosaic_window(urls, header, window, overview_level=None):
+    if len(urls) == 1:
+        return fetch_cog_window(urls[0], window, overview_level)
+    grid = window_metadata(header, window)
+    nodata = header['nodata'] or 0
+    mosaic = np.full((window.height, window.width), nodata, dtype=header['dtype'])
+    bounds = rasterio.windows.bounds(window, Affine(*header['transform']))
+    for url in urls:
+        missing = (mosaic == nodata)
+        if not missing.any():  # the COGs so far cover everything
+            break
+        source_header = get_cog_header(url, overview_level)
+        source_window = bounds_to_window(source_header, transform_bounds(grid.crs, CRS.from_wkt(source_header['crs']), *bounds), TILE_HALO)
+        if source_window.width == 0 or source_window.height == 0:
+            continue
+        data, metadata = fetch_cog_window(url, source_window, overview_level)
+        part = np.full_like(mosaic, nodata)
+        reproject(
+            source=data,
+            destination=part,
+            src_transform=metadata.transform,
+            src_crs=metadata.crs,
+            src_nodata=nodata,
+            dst_transform=grid.transform,
+            dst_crs=grid.crs,
+            dst_nodata=nodata,
+            resampling=Resampling.nearest,
+        )
+        mosaic[missing] = part[missing]
+    return mosaic, grid
+
+# Same as `fetch_cog_subset` for mosaics
+def fetch_mosaic_subset(urls, bbox_4326, overview_level=None):
+    header, window = get_mosaic_grid(urls, bbox_4326, overview_level)
+    return fetch_mosaic_window(urls, header, window, overview_level)
+
+# Splits `window` along the grid of the COG's internal blocks into tiles of TILE_BLOCKS x TILE_BLOCKS blocks (the
+# ones at the edges are smaller) and yields them as windows relative to `window`
+def iter_tiles(window, block_shape):
+    tile_height, tile_width = block_shape[0] * TILE_BLOCKS, block_shape[1] * TILE_BLOCKS
+    row_end, col_end = window.row_off + window.height, window.col_off + window.width
+    for row in range(window.row_off // tile_height * tile_height, row_end, tile_height):
+        for col in range(window.col_off // tile_width * tile_width, col_end, tile_width):
+            row_start, col_start = max(row, window.row_off), max(col, window.col_off)
+            yield Window(col_start - window.col_off, row_start - window.row_off,
+                         min(col + tile_width, col_end) - col_start, min(row + tile_height, row_end) - row_start)
+
+# One long-lived client for the whole process, its HTTP session keeps the connections to the catalog open
+def get_catalog():
+    global catalog
+    with catalog_lock:
+        if catalog is None:
+            catalog = stac.open(STAC_URL)
+        return catalog
 
 def get_search_result(bbox, start, end):
-    catalog = stac.open("https://earth-search.aws.element84.com/v1")
-    return catalog.search(
+    return get_catalog().search(
         max_items = None,
-        collections = ['sentinel-2-l2a'],
+        limit = 100,  # items per page, so that big searches don't need dozens of round trips
+        collections = [STAC_COLLECTION],
         bbox = bbox,
         datetime = [start+'T00:00:00Z', end+'T00:00:00Z'],
     )
 
+# Like `get_search_result`, but returns the list of items and caches it for SEARCH_CACHE_TTL seconds. Concurrent
+# identical searches wait for the first one instead of asking the catalog again.
+def search_items(bbox, start, end):
+    key = (tuple(bbox), start, end, STAC_COLLECTION)
+    now = datetime.now().timestamp()
+    with search_cache_lock:
+        for expired in [k for k, (searched, _) in search_cache.items() if now - searched > SEARCH_CACHE_TTL]:
+            del search_cache[expired]
+        running = key in search_cache
+        if running:
+            future = search_cache[key][1]
+        else:
+            future = Future()
+            search_cache[key] = (now, future)
+    if running:
+        return future.result()  # without holding the lock, the search may need it to remove itself when failing
+    try:
+        with measure('search'):
+            future.set_result(list(get_search_result(bbox, start, end).items()))
+    except Exception as err:
+        with search_cache_lock:
+            if search_cache.get(key, (None, None))[1] is future:
+                del search_cache[key]  # don't cache failures
+        future.set_exception(err)
+    return future.result()
+
+def count_matches(bbox, start, end):
+    return len(search_items(bbox, start, end))
+
 
 ###############################################################################
 
 
+# Durable copy of `jobs` (without the search results) plus a checkpoint for every scene of a job that is done, i.e.
+# whose outputs are in the job's archive (see `JobArchive.checkpoint`). When the server is restarted, the jobs that
+# weren't finished are queued again (see `resume_jobs`) and continue after their last checkpoint (see `process_job`).
+# There's one connection for all threads, so every access goes through the lock.
+class JobStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+        self.lock = Lock()
+
+    # The database is only opened when it's first needed, so importing this module doesn't create it
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)  # autocommit
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (jobname TEXT PRIMARY KEY, data TEXT NOT NULL, state TEXT NOT NULL, submitted REAL NOT NULL, matched INTEGER)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (jobname TEXT NOT NULL, scene TEXT NOT NULL, processed INTEGER NOT NULL, archive_end INTEGER NOT NULL, entries TEXT NOT NULL, PRIMARY KEY (jobname, scene))')
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def save_job(self, jobname, job):
+        self.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)', (jobname, json.dumps(job['data']), job['state'], job['submitted'], job.get('matched')))
+
+    # Jobs that were queued or processing (or still searching) when the server stopped, oldest first (failed ones stay
+    # failed, see `run_worker`)
+    def load_unfinished_jobs(self):
+        rows = self.execute("SELECT jobname, data, state, submitted, matched FROM jobs WHERE state NOT IN ('finished', 'failed') ORDER BY submitted")
+        return [(jobname, {'data': json.loads(data), 'state': state, 'percentage': None, 'submitted': submitted, 'matched': matched}) for jobname, data, state, submitted, matched in rows]
+
+    # `scene` identifies a group of items (see `get_scene_key`), the job's header (the .txt) has the empty string
+    def add_checkpoint(self, jobname, scene, processed, archive_end, entries):
+        self.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)', (jobname, scene, int(processed), archive_end, json.dumps(entries)))
+
+    # The checkpoints of a job in the order they were made, as (scene, processed, archive_end, entries) tuples
+    def get_checkpoints(self, jobname):
+        rows = self.execute('SELECT scene, processed, archive_end, entries FROM checkpoints WHERE jobname = ? ORDER BY rowid', (jobname,))
+        return [(scene, bool(processed), archive_end, json.loads(entries)) for scene, processed, archive_end, entries in rows]
+
+    # Keeps only the first `n` checkpoints of a job (the others didn't survive the verification)
+    def truncate_checkpoints(self, jobname, n):
+        self.execute('DELETE FROM checkpoints WHERE jobname = ? AND rowid NOT IN (SELECT rowid FROM checkpoints WHERE jobname = ? ORDER BY rowid LIMIT ?)', (jobname, jobname, n))
+
+    def delete_checkpoints(self, jobname):
+        self.execute('DELETE FROM checkpoints WHERE jobname = ?', (jobname,))
+
+job_store = JobStore(JOB_STORE)
+
+# Queues the jobs that were left unfinished by the last run, they keep their place in the queue (see `submit_job`)
+def resume_jobs():
+    for jobname, job in job_store.load_unfinished_jobs():
+        logging.info("Resuming " + jobname)
+        with jobs_lock:
+            jobs[jobname] = job
+        submit_job(job['data'], job['matched'])
+
+# Small jobs shouldn't wait behind a huge order, but huge orders mustn't starve either. So the queue is sorted by a
+# "virtual deadline": the submission time plus the estimated processing time of the job. A small job therefore
+# overtakes a big one that was submitted shortly before, but never one that has already waited longer than the
+# small job is expected to take.
+def submit_job(data, matched):
+    files_per_item = len(data['bands']) + len(data['indices']) + len(data['other'])
+    estimate = (matched or 0) * files_per_item * SECONDS_PER_FILE_ESTIMATE
+    jobname = data['jobname']
+    with jobs_lock:
+        job = jobs.setdefault(jobname, {'data': data, 'percentage': None, 'submitted': datetime.now().timestamp()})
+        job.update(state='queued', matched=matched)
+        deadline = job['submitted'] + estimate
+        job_store.save_job(jobname, job)
+    q.put((deadline, jobname))
+
+# A name for a new job made of the current time, with a suffix if another job got that name already (in the same
+# second, or before a restart). Call with `jobs_lock` held, and add the job to `jobs` before releasing it.
+def make_jobname():
+    base = datetime.now().strftime("job-%Y-%m-%d-%H-%M-%S")
+    jobname, n = base, 1
+    while jobname in jobs or os.path.exists('./jobs/' + jobname):
+        n += 1
+        jobname = base + '-' + str(n)
+    return jobname
+
+# Accepts an order right away (naming it with `make_jobname`, the name is returned) and counts its matches (needed for
+# `submit_job`) in the STAC pool, so the HTTP request doesn't have to wait for the catalog
+def order_job(data):
+    with jobs_lock:
+        data['jobname'] = make_jobname()
+        jobs[data['jobname']] = {'data': data, 'state': 'searching', 'percentage': None, 'submitted': datetime.now().timestamp()}
+        job_store.save_job(data['jobname'], jobs[data['jobname']])
+    def search_and_submit():
+        matched = None
+        try:
+            items = search_items(data['bbox'], data['start'], data['end'])
+            matched = len(items)
+            set_job_progress(data['jobname'], items=items)  # the worker uses these instead of searching again
+        except Exception:
+            logging.exception("Searching for " + data['jobname'] + " failed, queueing it without an estimate")
+        submit_job(data, matched)
+    stac_pool.submit(search_and_submit)
+    return data['jobname']
+
+# A job is ready once the worker is done with it, its archive is in place a bit earlier (before the report is written).
+# Jobs finished before a restart of the server aren't in `jobs`, for them the archive is all there is.
+def get_job_status(jobname):
+    with jobs_lock:
+        job = jobs.get(jobname)
+        return {
+            'ready': (job is None or job['state'] == 'finished') and any(os.path.isfile('./jobs/'+jobname+'/'+jobname+extension) for extension in DOWNLOAD_TYPES),
+            'queued': job is not None and job['state'] in ['searching', 'queued'],
+            'processing': job is not None and job['state'] == 'processing',
+            'failed': job is not None and job['state'] == 'failed',
+            'percentage': job['percentage'] if job is not None and job['state'] == 'processing' else None,
+        }
+
+# Queued jobs in the order they will be processed, preceded by the ones that are processing right now and followed by
+# the ones that are yet to be queued
+def get_queue():
+    with jobs_lock:
+        queued = [jobname for _, jobname in sorted(q.queue)]
+        processing = sorted([jobname for jobname, job in jobs.items() if job['state'] == 'processing'], key=lambda jobname: jobs[jobname]['started'])
+        searching = sorted([jobname for jobname, job in jobs.items() if job['state'] == 'searching'], key=lambda jobname: jobs[jobname]['submitted'])
+        return [{**jobs[jobname]['data'], 'state': jobs[jobname]['state'], 'percentage': jobs[jobname]['percentage']} for jobname in processing + queued + searching]
+
+def set_job_progress(jobname, **kwargs):
+    with jobs_lock:
+        jobs[jobname].update(kwargs)
+        if 'state' in kwargs:
+            job_store.save_job(jobname, jobs[jobname])
+
+# `metrics`, the tile cache statistics and the number of jobs per state in the Prometheus text format
+def format_metrics():
+    lines = []
+    def metric(name, kind, description, samples):
+        lines.append('# HELP s2_batch_download_%s %s' % (name, description))
+        lines.append('# TYPE s2_batch_download_%s %s' % (name, kind))
+        for labels, value in samples:
+            labels = ','.join('%s="%s"' % label for label in labels.items())
+            lines.append('s2_batch_download_%s%s %s' % (name, '{' + labels + '}' if labels else '', value))
+
+    stats = metrics.as_dict()
+    stages = sorted(stats['stages'].items())
+    metric('stage_seconds_total', 'counter', 'Time spent per processing stage, summed over all threads', [({'stage': stage}, totals['seconds']) for stage, totals in stages])
+    metric('stage_calls_total', 'counter', 'Number of times each processing stage ran', [({'stage': stage}, totals['calls']) for stage, totals in stages])
+    metric('stage_bytes_total', 'counter', 'Bytes read (decoded) or written per processing stage', [({'stage': stage}, totals['bytes']) for stage, totals in stages])
+    for counter, value in sorted(stats['counters'].items()):
+        metric(counter + '_total', 'counter', counter.replace('_', ' ').capitalize(), [({}, value)])
+
+    cache = tile_cache.stats()
+    metric('cache_hits_total', 'counter', 'Tile cache hits', [({}, cache['hits'])])
+    metric('cache_misses_total', 'counter', 'Tile cache misses', [({}, cache['misses'])])
+    metric('cache_evictions_total', 'counter', 'Entries evicted from the tile cache', [({}, cache['evictions'])])
+    metric('cache_served_bytes_total', 'counter', 'Bytes served from the tile cache', [({}, cache['bytes_served'])])
+    metric('cache_size_bytes', 'gauge', 'Size of the tile cache', [({}, cache['size_bytes'])])
+
+    states = {'searching': 0, 'queued': 0, 'processing': 0}
+    for job in get_queue():
+        states[job['state']] = states.get(job['state'], 0) + 1
+    metric('jobs', 'gauge', 'Jobs that are not finished yet, by state', [({'state': state}, n) for state, n in states.items()])
+    return '\n'.join(lines) + '\n'
+
+
+
+###############################################################################
+
+
+# Results of a job, `<jobname>.zip` (see `JobArchive`) or `<jobname>.nc` (see `Datacube`), and their content types
+DOWNLOAD_TYPES = {'.zip': 'application/zip', '.nc': 'application/x-netcdf'}
+
+# The files of the web GUI (the build in `directory`), read and compressed once and then served from memory. Every
+# file has an ETag (a hash of its content) and a Last-Modified, so browsers can revalidate their copies (and get a 304
+# if nothing changed). The files in assets/ have a hash in their names and change name when their content changes, so
+# browsers may keep them without asking. index.html has to be revalidated, it's what refers to the current ones.
+class StaticFiles:
+    COMPRESSIBLE = ['text/', 'application/javascript', 'application/json', 'image/svg+xml']
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = None  # url path -> dict, see `load_file`
+        self.lock = Lock()
+
+    def load(self):
+        files = {}
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                files['/' + os.path.relpath(path, self.directory).replace(os.sep, '/')] = self.load_file(path)
+        if '/index.html' in files:
+            files['/'] = files['/index.html']
+        with self.lock:
+            self.files = files
+        logging.info("Loaded " + str(len(files)) + " files of the web GUI from " + self.directory)
+
+    def load_file(self, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+            mtime = os.fstat(f.fileno()).st_mtime
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/javascript':
+            content_type += '; charset=utf-8'
+        variants = {'identity': content}  # content encoding -> bytes
+        if any(content_type.startswith(prefix) for prefix in self.COMPRESSIBLE):
+            variants['gzip'] = gzip.compress(content, 9, mtime=0)
+            if brotli is not None:
+                variants['br'] = brotli.compress(content)
+            variants = {encoding: data for encoding, data in variants.items() if encoding == 'identity' or len(data) < len(content)}
+        return {
+            'variants': variants,
+            'type': content_type,
+            'etag': '"' + hashlib.sha1(content).hexdigest()[:20] + '"',
+            'last_modified': formatdate(mtime, usegmt=True),
+            'cache_control': 'public, max-age=31536000, immutable' if '/assets/' in path.replace(os.sep, '/') else 'no-cache',
+        }
+
+    # The file for the url `path` (without query), None if there's none
+    def get(self, path):
+        if self.files is None:
+            self.load()
+        return self.files.get(path.split('?')[0])
+
+ui_files = StaticFiles('./ui/dist')
+
+# The content encoding of `variants` (see `StaticFiles.load_file`) that is the smallest of those accepted by a client
+# that sent `accept_encoding`
+def choose_encoding(variants, accept_encoding):
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        encoding, _, parameters = part.strip().partition(';')
+        if parameters.strip().replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']:
+            accepted.add(encoding.strip().lower())
+    candidates = [encoding for encoding in variants if encoding == 'identity' or encoding in accepted or '*' in accepted]
+    return min(candidates, key=lambda encoding: len(variants[encoding]))
+
+# Whether `etag` is one of the (strong or weak) tags in an If-None-Match header
+def etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+
+# Whether a client that sent `headers` has the version of `static_file` already
+def is_not_modified(static_file, headers):
+    if headers['If-None-Match'] is not None:  # takes precedence over If-Modified-Since
+        return etag_matches(static_file['etag'], headers['If-None-Match'])
+    if headers['If-Modified-Since'] is not None:
+        try:
+            return parsedate_to_datetime(headers['If-Modified-Since']) >= parsedate_to_datetime(static_file['last_modified'])
+        except (TypeError, ValueError):
+            return False
+    return False
+
 class S(BaseHTTPRequestHandler):
     def send_cors_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', '*')
     
-    def do_GET(self):
-        self.send_response(200, "ok")
-        self.send_cors_headers()
-        
-        logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
+    # Sends a file from disk with constant memory usage (via sendfile where possible), supporting conditional requests
+    # via ETag/If-None-Match and single byte ranges (so interrupted downloads can be resumed)
+    def send_file(self, filename, content_type, head=False):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self.send_error(404, 'File Not Found: %s' % self.path)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+
+            if etag_matches(etag, self.headers['If-None-Match']):
+                self.send_response(304)
+                self.send_cors_headers()
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
 
-        if self.path == '/':
-            f = open('./ui/dist/index.html', 'rb')
-            self.send_header('Content-type', 'text/html')
+            start, end = 0, size-1
+            byte_range = self.headers['Range']
+            if byte_range and self.headers['If-Range'] not in [None, etag]:  # the file changed since the client got the first part
+                byte_range = None
+            if not (byte_range and byte_range.startswith('bytes=') and ',' not in byte_range):  # multiple ranges are answered with the whole file
+                byte_range = None
+            if byte_range:
+                first, _, last = byte_range[len('bytes='):].strip().partition('-')
+                try:
+                    if first:
+                        start, end = int(first), (min(int(last), size-1) if last else size-1)
+                    else:  # suffix range, i.e. the last n bytes
+                        start, end = max(0, size-int(last)), size-1
+                except ValueError:  # invalid ranges are ignored, i.e. answered with the whole file
+                    start, end = 0, size-1
+                    byte_range = None
+            if byte_range:
+                if start > end or start >= size:
+                    self.send_response(416)  # 416 = Range Not Satisfiable
+                    self.send_cors_headers()
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            else:
+                self.send_response(200, "ok")
+            self.send_cors_headers()
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end-start+1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
             self.end_headers()
-            self.wfile.write(f.read())
-            f.close()
+            if not head:
+                self.connection.sendfile(f, start, end-start+1)  # falls back to chunked send() if sendfile isn't available
+
+    def send_download(self, head=False):
+        jobname, extension = os.path.splitext(self.path.replace('/download/',''))
+        extension = extension or '.zip'
+        if '/' in jobname or jobname.startswith('.') or extension not in DOWNLOAD_TYPES:
+            self.send_error(404, 'File Not Found: %s' % self.path)
             return
-        
-        if self.path.startswith('/assets/'):
-            filename = self.path.replace('/assets/','')
-            f = open('./ui/dist/assets/'+filename, 'rb')
-            if self.path.endswith('.css'):
-                self.send_header('Content-type', 'text/css')
-            else:
-                self.send_header('Content-type', 'application/javascript')
+        filename = './jobs/' + jobname + '/'+jobname+extension
+        logging.info(filename)
+        self.send_file(filename, DOWNLOAD_TYPES[extension], head)
+
+    # Sends a file of the web GUI from `ui_files`, compressed if the client accepts that
+    def send_static(self, static_file, head=False):
+        if is_not_modified(static_file, self.headers):
+            self.send_response(304)
+            self.send_cors_headers()
+            if len(static_file['variants']) > 1:
+                self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('ETag', static_file['etag'])
+            self.send_header('Cache-Control', static_file['cache_control'])
             self.end_headers()
-            self.wfile.write(f.read())
-            f.close()
             return
+        encoding = choose_encoding(static_file['variants'], self.headers['Accept-Encoding'])
+        content = static_file['variants'][encoding]
+        self.send_response(200, "ok")
+        self.send_cors_headers()
+        self.send_header('Content-Type', static_file['type'])
+        self.send_header('Content-Length', str(len(content)))
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+        if len(static_file['variants']) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', static_file['etag'])
+        self.send_header('Last-Modified', static_file['last_modified'])
+        self.send_header('Cache-Control', static_file['cache_control'])
+        self.end_headers()
+        if not head:
+            self.wfile.write(content)
 
+    def do_HEAD(self):
         if self.path.startswith("/download/"):
-            try:
-                jobname = self.path.replace('/download/','').replace('.zip','')
-                filename = './jobs/' + jobname + '/'+jobname+'.zip'
-                logging.info(filename)
-                f = open(filename, 'rb')
-                self.send_header('Content-type', 'application/zip')
-                self.end_headers()
-                self.wfile.write(f.read())
-                f.close()
-                return
-            except IOError:
-                self.send_error(404,'File Not Found: %s' % self.path)
+            self.send_download(head=True)
+            return
+        static_file = ui_files.get(self.path)
+        if static_file is not None:
+            self.send_static(static_file, head=True)
+            return
+        self.send_error(405)
+
+    def do_GET(self):
+        logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
+
+        if self.path.startswith("/download/"):
+            self.send_download()
+            return
+
+        static_file = ui_files.get(self.path)  # the web GUI, i.e. / and /assets/...
+        if static_file is not None:
+            self.send_static(static_file)
+            return
+
+        if self.path == '/' or self.path.startswith('/assets/'):  # not in ./ui/dist (not built?)
+            self.send_error(404, 'File Not Found: %s' % self.path)
+            return
 
-        if self.path == '/put':
-            q.put({
+        self.send_response(200, "ok")
+        self.send_cors_headers()
+
+        if self.path == '/put':  # orders an example job
+            jobname = order_job({
                 'bbox': [13.18260, 53.81978, 13.286973, 53.840044],  # format: xmin, ymin, xmax, ymax (order: lon, lat) (CRS: WGS 84, EPSG:4326)
                 'start': '2024-03-05',  # format: YYYY-MM-DD
                 'end': '2024-03-23',  # format: YYYY-MM-DD
+                'max_cloud_cover': 50,
                 # band number to name mappings: 1=coastal, 2=blue, 3=green, 4=red, 5=rededge1, 6=rededge2, 7=rededge3, 8=nir, 8a=nir08, 9=nir09, 11=swir16, 12=swir22
                 'bands': ['coastal', 'blue', 'green', 'red', 'rededge1', 'rededge2', 'rededge3', 'nir', 'nir08', 'nir09', 'swir16', 'swir22'],
-                'indices': ['ndvi'],  # not implemented yet
-                'pattern': 'out/yymmdd-name.tiff'  # any folder structure must exist
+                'indices': ['ndvi'],
+                'other': [],
+                'pattern': 'yymmdd-tile-name.tiff'
                 })
-        
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'jobname': jobname}).encode('utf-8'))
+            return
+
+        if self.path == '/api/cache':
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(tile_cache.stats()).encode('utf-8'))
+            return
+
+        if self.path == '/metrics':
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(format_metrics().encode('utf-8'))
+            return
+
         if self.path == '/api/queue/length':
             self.end_headers()
             self.wfile.write(str(q.qsize()).encode('utf-8'))
@@ -136,18 +1046,24 @@ class S(BaseHTTPRequestHandler):
         if self.path == '/api/queue':
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
-            logging.info(list(q.queue))
-            self.wfile.write(str(list(q.queue)).replace("'", '"').encode('utf-8'))  # The `replace` is a hack to make the Python output a valid JSON
+            reply = json.dumps(get_queue())
+            logging.info(reply)
+            self.wfile.write(reply.encode('utf-8'))
             return
         
+        # the "current" endpoints date from the time when there was only one worker, they refer to the job that has been processing the longest
         if self.path == '/api/jobs/current/percentage':
             self.end_headers()
+            current = [job for job in get_queue() if job['state'] == 'processing']
+            percentage = current[0]['percentage'] if current else None
             self.wfile.write(str(percentage).encode('utf-8'))
             logging.info("Current Job Percentage: " + str(percentage))
             return
         
         if self.path == '/api/jobs/current/id':
             self.end_headers()
+            current = [job for job in get_queue() if job['state'] == 'processing']
+            current_job = current[0]['jobname'] if current else None
             self.wfile.write(str(current_job).encode('utf-8'))  # wrap in str(...) in case it's None
             logging.info("Current Job ID: " + str(current_job))
             return
@@ -156,13 +1072,7 @@ class S(BaseHTTPRequestHandler):
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
             jobname = self.path.replace('/api/jobs/', '')
-            ready = os.path.isfile('./jobs/'+jobname+'/'+jobname+'.zip')
-            processing = (current_job == jobname)
-            reply = ('{' +
-                     '"ready":' + ('true' if ready else 'false') + ',' +
-                     '"processing":' + ('true' if processing else 'false') + ',' +
-                     '"percentage":' + (str(percentage) if processing and percentage is not None else 'null') +
-                     '}')
+            reply = json.dumps(get_job_status(jobname))
             logging.info(reply)
             self.wfile.write(reply.encode('utf-8'))
             return
@@ -204,7 +1114,7 @@ class S(BaseHTTPRequestHandler):
             return
 
         # read spatiotemporal extent into variables
-        bbox, start, end, *rest = data.values()
+        bbox, start, end = data['bbox'], data['start'], data['end']
         
         # enforce bbox=minx,miny,maxx,maxy and startdate<enddate
         if bbox[0]>=bbox[2] or bbox[1]>=bbox[3] or start>=end:   # the dates are comparable via "number-style string comparison" due to the hierarchical YYYY-MM-DD format
@@ -214,31 +1124,49 @@ class S(BaseHTTPRequestHandler):
             self.wfile.write("ensure bbox format of minx,miny,maxx,maxy and startdate<enddate".encode('utf-8'))
             return
         
-        # if we've made it this far, the transmitted job is okay
-        self.send_response(200, "ok")
-        self.send_cors_headers()
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
+        if data.get('output_format') == 'netcdf' and netCDF4 is None:
+            self.send_response(400)
+            self.send_cors_headers()
+            self.end_headers()
+            self.wfile.write("NetCDF output is not available on this server (the netCDF4 package is missing)".encode('utf-8'))
+            return
 
-        # do the search in the STAC catalog
-        search = get_search_result(bbox, start, end)
+        # if we've made it this far, the transmitted job is okay
         
         if(self.path == '/api/check'):
-            item_count = search.matched()
+            # do the search in the STAC catalog (in the STAC pool, this thread only waits for it)
+            try:
+                item_count = stac_pool.submit(count_matches, bbox, start, end).result(timeout=STAC_TIMEOUT)
+            except Exception as err:
+                logging.exception("Search failed")
+                self.send_response(504)  # 504 = Gateway Timeout
+                self.send_cors_headers()
+                self.end_headers()
+                self.wfile.write(("STAC search failed: " + (str(err) or type(err).__name__)).encode('utf-8'))
+                return
+            self.send_json_headers()
             #files_per_item = len(bands) + len(indices)
             #out = f"Your search matched {item_count} items"
             #out += f"You requested {len(bands)} bands and {len(indices)} indices, i.e. {files_per_item} files per item"
             #out += f"That means you will download {item_count*files_per_item} files in total"
             #self.wfile.write(out.encode('utf-8'))
             self.wfile.write(('{"matched":' + str(item_count) + '}').encode('utf-8'))
+            return
 
         if(self.path == '/api/order'):
             logging.info('Putting to queue')
-            jobname = datetime.now().strftime("job-%Y-%m-%d-%H-%M-%S")
-            data['jobname'] = jobname
-            q.put(data)
+            jobname = order_job(data)
+            self.send_json_headers()
             self.wfile.write(('{"jobname":"' + jobname + '"}').encode('utf-8'))
+            return
 
+        self.send_error(404)
+
+    def send_json_headers(self):
+        self.send_response(200, "ok")
+        self.send_cors_headers()
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
 
     def do_OPTIONS(self):
         self.send_response(200, "ok")
@@ -249,10 +1177,12 @@ class S(BaseHTTPRequestHandler):
 ###############################################################################
 
 
-def run_server(server_class=HTTPServer, handler_class=S, port=8765):
+# Every request is handled in its own thread, so slow requests (searches, downloads) don't hold up the others
+def run_server(server_class=ThreadingHTTPServer, handler_class=S, port=8765):
     logging.basicConfig(level=logging.INFO)
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
+    httpd.daemon_threads = True
     logging.info('Starting httpd...\n')
     try:
         httpd.serve_forever()
@@ -265,19 +1195,44 @@ def run_server(server_class=HTTPServer, handler_class=S, port=8765):
 ###############################################################################
 
 
+# Path of an output file within the job's ZIP archive
 def make_filename(pattern, name, info):
-    filename = pattern.replace('name', name).replace('tile', info['tile']).replace('yymmdd', info['yymmdd'])
-    return './jobs/' + info['jobname'] + '/' + filename
+    return pattern.replace('name', name).replace('tile', info['tile']).replace('yymmdd', info['yymmdd'])
 
 class Metadata:
-    def __init__(self, width, height, crs, transform):
+    def __init__(self, width, height, crs, transform, nodata=None):
         self.width = width
         self.height = height
         self.crs = crs
         self.transform = transform
+        self.nodata = nodata
+
+# Ways of writing the output GeoTIFFs, selected per job by "output_profile" (see job-schema.json). All of them keep the
+# dtype of the data and the nodata value of the source bands. The COG ones are tiled, have overviews and are compressed
+# with a predictor (horizontal differencing for integers, floating point for indices). LERC is lossless for integers,
+# but stores floats (i.e. indices) only up to LERC_MAX_Z_ERROR, which makes them a lot smaller.
+COG_LAYOUT = {'driver': 'COG', 'blocksize': 512, 'overviews': 'AUTO', 'overview_resampling': 'average', 'bigtiff': 'IF_SAFER'}
+OUTPUT_PROFILES = {
+    'gtiff':       {'driver': 'Gtiff'},  # uncompressed and untiled
+    'cog-deflate': {**COG_LAYOUT, 'compress': 'DEFLATE', 'predictor': 'YES'},
+    'cog-zstd':    {**COG_LAYOUT, 'compress': 'ZSTD', 'level': 9, 'predictor': 'YES'},
+    'cog-lerc':    {**COG_LAYOUT, 'compress': 'LERC_ZSTD', 'max_z_error': LERC_MAX_Z_ERROR},
+}
 
-# The `metadata` parameter can be a DatasetReader or of class Metadata (it's only important that it has `width`, `height`, `crs` and `transform` available via the dot operator)
-def save_as_tiff(data, metadata, filename):
+# Creation options for writing data of `dtype` with `profile`
+def get_creation_options(profile, dtype):
+    options = dict(OUTPUT_PROFILES[profile])
+    if 'max_z_error' in options and np.dtype(dtype).kind in 'iu':
+        options['max_z_error'] = 0
+    return options
+
+# Whether files written with `profile` are compressed already (so the ZIP archive only has to store them)
+def is_compressed(profile):
+    return 'compress' in OUTPUT_PROFILES[profile]
+
+# The `metadata` parameter can be a DatasetReader or of class Metadata (it's only important that it has `width`, `height`, `crs`, `transform` and `nodata` available via the dot operator)
+# The dtype of the file is the one of `data`, the format is given by one of the OUTPUT_PROFILES
+def save_as_tiff(data, metadata, filename, profile='gtiff'):
     data_shape = np.shape(data)
     if len(data_shape) == 2:   # single band case -> is 2D
         number_of_bands = 1    # obviously
@@ -290,36 +1245,216 @@ def save_as_tiff(data, metadata, filename):
     with rasterio.open(
         filename,
         'w',
-        driver ='Gtiff',
         width = metadata.width,
         height = metadata.height,
         count = number_of_bands,
         crs = metadata.crs,
         transform = metadata.transform,
-        dtype = 'float64'
+        dtype = data.dtype,
+        nodata = metadata.nodata,
+        **get_creation_options(profile, data.dtype)
     ) as tiff:
         tiff.write(data, bands_to_write_to)
 
-# Takes a coarser array of shape (x,y) and a finer array of shape (2x+a,2y+b) where a,b can be 0 or 1 independently
-# Returns the coarser array doubled in both dimensions, the finer array with possibly the last row and/or column removed to fit the shape of the other array, and the new shape
-def resample_to_same_shape(finer_array, coarser_array):
-    doubled_v = np.repeat(coarser_array, 2, axis=0)
-    doubled_vh = np.repeat(doubled_v, 2, axis=1)
-    result2 = doubled_vh
-    shape_to_match = np.shape(result2)
-    shape_of_finer = np.shape(finer_array)
-    result1 = finer_array
-    if shape_of_finer[0] > shape_to_match[0]:
-        result1 = np.delete(result1, shape_of_finer[0]-1, 0)
-    if shape_of_finer[1] > shape_to_match[1]:
-        result1 = np.delete(result1, shape_of_finer[1]-1, 1)
-    if shape_of_finer[0] < shape_to_match[0]:
-        result2 = np.delete(result2, shape_to_match[0]-1, 0)
-        shape_to_match = (shape_to_match[0]-1, shape_to_match[1])
-    if shape_of_finer[1] < shape_to_match[1]:
-        result2 = np.delete(result2, shape_to_match[1]-1, 1)
-        shape_to_match = (shape_to_match[0], shape_to_match[1]-1)
-    return result1, result2, shape_to_match
+def tiff_bytes(data, metadata, profile='gtiff'):
+    with MemoryFile() as memfile:
+        save_as_tiff(data, metadata, memfile.name, profile)
+        return memfile.read()
+
+# What's needed of a ZipInfo to rebuild the central directory of an archive, see `JobArchive.resume`
+ZIPINFO_FIELDS = ['filename', 'date_time', 'compress_type', 'CRC', 'compress_size', 'file_size', 'header_offset', 'external_attr', 'create_version', 'extract_version', 'flag_bits']
+
+# The job's ZIP archive, which outputs are written to right when they are produced (instead of zipping the job folder
+# at the end). It's called `<jobname>.zip.part` until it's complete.
+class JobArchive:
+    def __init__(self, jobname):
+        self.filename = './jobs/' + jobname + '/' + jobname + '.zip'
+        self.zip = zipfile.ZipFile(self.filename + '.part', 'w', allowZip64=True)
+        self.checkpointed = 0  # number of entries covered by checkpoints
+        self.checkpoint_end = 0  # and where they end
+
+    # Makes everything that was added so far durable and returns the offset at which the next entry starts together
+    # with the entries added since the last checkpoint, for `JobStore.add_checkpoint`
+    def checkpoint(self):
+        self.zip.fp.flush()
+        os.fsync(self.zip.fp.fileno())
+        entries = [{field: getattr(info, field) for field in ZIPINFO_FIELDS} for info in self.zip.filelist[self.checkpointed:]]
+        self.checkpointed = len(self.zip.filelist)
+        self.checkpoint_end = self.zip.start_dir
+        return self.zip.start_dir, entries
+
+    # Drops everything that was added after the last checkpoint, e.g. the first outputs of a scene that failed
+    def rollback(self):
+        del self.zip.filelist[self.checkpointed:]
+        self.zip.NameToInfo = {info.filename: info for info in self.zip.filelist}
+        self.zip.start_dir = self.checkpoint_end
+        self.zip.fp.seek(self.checkpoint_end)
+        self.zip.fp.truncate()
+
+    # Continues the archive of an interrupted job from its `checkpoints` (as returned by `JobStore.get_checkpoints`).
+    # The central directory is missing (it's only written by `close`), so whatever was written after the last
+    # checkpoint is cut off and zipfile, which appends to files that aren't ZIP archives, is given the entries from the
+    # checkpoints. These are read back to verify their CRCs, at the first one that doesn't match the archive is cut
+    # off again before the checkpoint it belongs to. Returns the archive and the number of checkpoints that are valid.
+    @classmethod
+    def resume(cls, jobname, checkpoints):
+        archive = cls.__new__(cls)
+        archive.filename = './jobs/' + jobname + '/' + jobname + '.zip'
+        with open(archive.filename + '.part', 'r+b') as f:
+            f.truncate(checkpoints[-1][2])
+        archive.zip = zipfile.ZipFile(archive.filename + '.part', 'a', allowZip64=True)
+        archive.checkpointed, archive.checkpoint_end = 0, 0
+        for n, (_, _, _, entries) in enumerate(checkpoints):
+            infos = []
+            for entry in entries:
+                info = zipfile.ZipInfo(entry['filename'], tuple(entry['date_time']))
+                for field in ZIPINFO_FIELDS[2:]:
+                    setattr(info, field, entry[field])
+                infos.append(info)
+                archive.zip.filelist.append(info)
+                archive.zip.NameToInfo[info.filename] = info
+            try:
+                for info in infos:
+                    with archive.zip.open(info) as f:
+                        while f.read(2**20):
+                            pass
+            except (zipfile.BadZipFile, EOFError, OSError, zlib.error) as err:
+                logging.warning("Archive of " + jobname + " is damaged after checkpoint " + str(n) + ": " + str(err))
+                archive.rollback()
+                return archive, n
+            archive.checkpointed = len(archive.zip.filelist)
+            archive.checkpoint_end = checkpoints[n][2]
+        return archive, len(checkpoints)
+
+    # Files that are compressed already are only stored, re-deflating them would just waste CPU
+    def add(self, arcname, content, compressed):
+        info = zipfile.ZipInfo(arcname, datetime.now().timetuple()[:6])
+        info.compress_type = zipfile.ZIP_STORED if compressed else zipfile.ZIP_DEFLATED
+        with measure('archive') as measured:
+            self.zip.writestr(info, content)
+            measured['bytes'] = info.compress_size
+
+    # Same for a file on disk, which is copied in chunks instead of being read into memory
+    def add_file(self, arcname, filename, compressed):
+        with measure('archive') as measured:
+            self.zip.write(filename, arcname, compress_type=zipfile.ZIP_STORED if compressed else zipfile.ZIP_DEFLATED)
+            measured['bytes'] = self.zip.infolist()[-1].compress_size
+
+    def close(self):
+        self.zip.close()
+        os.replace(self.filename + '.part', self.filename)
+
+# Writes an output of the item described by `info` into the job's archive
+def save_output(data, metadata, pattern, name, info):
+    filename = make_filename(pattern, name, info)
+    logging.info(filename)
+    with measure('write') as measured:
+        content = tiff_bytes(data, metadata, info['profile'])
+        measured['bytes'] = len(content)
+    info['archive'].add(filename, content, compressed=is_compressed(info['profile']))
+
+# All calls into netCDF4 go through this lock, the HDF5 library underneath isn't thread-safe (not even for different files)
+netcdf_lock = Lock()
+
+# The result of a job with "output_format": "netcdf": instead of a ZIP archive of GeoTIFFs, one NetCDF file with a
+# (time, y, x) variable per band and index, which scenes are appended to along the (unlimited) time axis as soon as
+# they are processed. It's called `<jobname>.nc.part` until it's complete. All variables are on the grid of `window` of
+# the COG described by `header`, compressed with zlib in chunks of one time step and DATACUBE_CHUNK_SIZE pixels
+# squared. The CRS is given by the CF grid mapping variable 'spatial_ref', which GDAL and xarray/rioxarray understand.
+# `variables` maps names to (dtype, nodata) tuples. Without a `header` (i.e. no scene to take the grid from) there's
+# only the time axis.
+class Datacube:
+    def __init__(self, jobname, header, window, variables, attributes):
+        self.filename = './jobs/' + jobname + '/' + jobname + '.nc'
+        self.header, self.window = header, window
+        self.grid = window_metadata(header, window) if header else None
+        with netcdf_lock:
+            self.dataset = netCDF4.Dataset(self.filename + '.part', 'w', format='NETCDF4')
+            self.dataset.setncatts({'Conventions': 'CF-1.8', **attributes})
+            self.dataset.createDimension('time', None)
+            time_axis = self.dataset.createVariable('time', 'f8', ('time',))
+            time_axis.setncatts({'standard_name': 'time', 'units': 'seconds since 1970-01-01 00:00:00', 'calendar': 'standard'})
+            scenes = self.dataset.createVariable('tile', str, ('time',))
+            scenes.long_name = 'MGRS tile(s) of the scene'
+            if self.grid is None:
+                return
+
+            grid = self.grid
+            self.chunk_shape = (min(DATACUBE_CHUNK_SIZE, grid.height), min(DATACUBE_CHUNK_SIZE, grid.width))
+            self.dataset.createDimension('y', grid.height)
+            self.dataset.createDimension('x', grid.width)
+            for axis, size, origin, step in [('y', grid.height, grid.transform.f, grid.transform.e), ('x', grid.width, grid.transform.c, grid.transform.a)]:
+                coordinate = self.dataset.createVariable(axis, 'f8', (axis,))
+                coordinate.setncatts({'standard_name': 'projection_%s_coordinate' % axis, 'units': 'm'})
+                coordinate[:] = origin + (np.arange(size) + 0.5) * step  # pixel centres
+            spatial_ref = self.dataset.createVariable('spatial_ref', 'i4')
+            spatial_ref.setncatts({'crs_wkt': grid.crs.to_wkt(), 'spatial_ref': grid.crs.to_wkt(), 'GeoTransform': ' '.join(str(value) for value in grid.transform.to_gdal())})
+            for name, (dtype, nodata) in variables.items():
+                variable = self.dataset.createVariable(name, dtype, ('time', 'y', 'x'), zlib=True, complevel=4, shuffle=True,
+                                                       chunksizes=(1, *self.chunk_shape), fill_value=False if nodata is None else nodata)
+                variable.grid_mapping = 'spatial_ref'
+
+    # Adds a time step for a scene and returns its position on the time axis
+    def append(self, timestamp, tile):
+        with netcdf_lock:
+            t = len(self.dataset.dimensions['time'])
+            self.dataset['time'][t] = timestamp
+            self.dataset['tile'][t] = tile
+        return t
+
+    # `tile` is a window relative to the grid, without one the whole time step is written
+    def write(self, name, t, data, tile=None):
+        tile = tile or Window(0, 0, self.grid.width, self.grid.height)
+        with netcdf_lock, measure('write') as measured:
+            self.dataset[name][t, tile.row_off:tile.row_off+tile.height, tile.col_off:tile.col_off+tile.width] = data
+            measured['bytes'] = data.nbytes
+
+    def close(self):
+        with netcdf_lock:
+            self.dataset.close()
+        os.replace(self.filename + '.part', self.filename)
+
+# Datacube for the scenes of a job (groups of items, see `group_items`), on the grid of the finest of `bands_to_download`
+# in the first scene. The others are resampled onto it if theirs differs (e.g. a neighbouring MGRS tile). Across UTM
+# zones that's approximated by GDAL like for mosaics (see `fetch_mosaic_window`), so the tiled mode can differ slightly.
+def create_datacube(jobname, groups, bands_to_download, bands, indices, bbox, data):
+    header, window, variables = None, None, {}
+    if groups and bands_to_download:
+        grids = {band: get_mosaic_grid([item.assets[band].href for item in groups[0]], bbox) for band in bands_to_download}
+        header, window = min(grids.values(), key=lambda grid: abs(grid[0]['transform'][0]))
+        for band in bands:
+            variables[band] = (grids[band][0]['dtype'], grids[band][0]['nodata'])
+        for index in indices:
+            variables[index] = (INDEX_DTYPE, np.nan)
+    return Datacube(jobname, header, window, variables, {'job': json.dumps(data)})
+
+# Writes the bands and indices of a scene into time step `t` of `cube`
+def add_to_datacube(cube, t, item_bands, bands, indices, resampling):
+    for band in bands:
+        data, metadata = item_bands[band]
+        with measure('resample'):
+            data = resample_to_grid(data, metadata, cube.grid, resampling, data.dtype)
+        cube.write(band, t, data)
+    for indexname, result, _ in compute_indices(indices, item_bands, resampling, cube.grid):
+        cube.write(indexname, t, result)
+
+# Resamples `data` (with the georeferencing given by `metadata`) onto `grid` (a Metadata as well) in a single pass,
+# e.g. a 20 m band onto the 10 m grid of the same AOI. Both grids are aligned, so nothing has to be trimmed.
+# `resampling` is 'nearest', 'bilinear' or 'average'.
+def resample_to_grid(data, metadata, grid, resampling, dtype):
+    if data.shape == (grid.height, grid.width) and metadata.transform == grid.transform and metadata.crs == grid.crs:
+        return data.astype(dtype)
+    destination = np.zeros((grid.height, grid.width), dtype=dtype)
+    reproject(
+        source=data,
+        destination=destination,
+        src_transform=metadata.transform,
+        src_crs=metadata.crs,
+        dst_transform=grid.transform,
+        dst_crs=grid.crs,
+        resampling=Resampling[resampling],
+    )
+    return destination
 
 # important: the first entry is the band that is used in the *numerator* of the corresponding formula, the second entry the one in the *denominator*
 # this is also the reason why they are arrays and not sets
@@ -337,180 +1472,723 @@ BANDS_FOR_INDICES = {
     'mois':  ['nir08', 'swir16'],
 }
 
-def calculate_index(indexname, pattern, info):
-    # formulas based on a rather simple fraction ("normalized difference" and very similar)
-    if indexname in ['ndvi', 'ndyi', 'ndre', 'ndsi', 'ngrdi', 'mois', 'vari', 'msi']:
-        bandname1 = BANDS_FOR_INDICES[indexname][0]
-        bandname2 = BANDS_FOR_INDICES[indexname][1]
-        with rasterio.open(make_filename(pattern, bandname1, info)) as src_band1:
-            with rasterio.open(make_filename(pattern, bandname2, info)) as src_band2:
-                # load bands
-                band1 = src_band1.read(1).astype('float64')
-                band2 = src_band2.read(1).astype('float64')
-
-                # resample if necessary
-                band1_shape = np.shape(band1)
-                band2_shape = np.shape(band2)
-                final_shape = None
-                final_transform = None
-                final_crs = src_band1.crs  # they are all the same anyway
-                if band1_shape[0] > band2_shape[0]:  # detect which one is the coarser and which one the finer array
-                    band1, band2, final_shape = resample_to_same_shape(band1, band2)  # resample (and store possibly altered shape)
-                    final_transform = src_band1.transform  # use the transform of the finer array because it has the 10m resolution, not the 20m
-                elif band1_shape[0] < band2_shape[0]:  # the same vice versa
-                    band2, band1, final_shape = resample_to_same_shape(band2, band1)
-                    final_transform = src_band2.transform
-                else:
-                    final_shape = band1_shape  # both are the same -> doesn't matter if it's 1 or 2
-                    final_transform = src_band1.transform
-
-                # calculate
-                numerator = (band1-band2)  # default case (normalized difference)
-                denominator = (band1+band2)
-                if indexname == 'msi':  # more simple case where formula is just the ratio of the bands without any normalization
-                    numerator = band1
-                    denominator = band2
-                if indexname == 'vari':  # special case where additionally to the normal formula blue is subtracted from the denominator
-                    with rasterio.open(make_filename(pattern, 'blue', info)) as src_band3:
-                        band3 = src_band3.read(1).astype('float64')
-                        denominator -= band3
-                result = np.where(denominator==0., 0, numerator/denominator)  # set 0 where division would be undefined
-
-                # save
-                metadata = Metadata(final_shape[1], final_shape[0], final_crs, final_transform)
-                save_as_tiff(result, metadata, make_filename(pattern, indexname, info))
-
-    # more special formulas
-
-    if indexname == 'evi':
-        with rasterio.open(make_filename(pattern, 'red', info)) as red_src:
-            with rasterio.open(make_filename(pattern, 'nir', info)) as nir_src:
-                with rasterio.open(make_filename(pattern, 'blue', info)) as blue_src:
-                    red = red_src.read(1).astype('float64') / 10000
-                    nir = nir_src.read(1).astype('float64') / 10000
-                    blue = blue_src.read(1).astype('float64') / 10000
-                    G = 2.5
-                    C1 = 6
-                    C2 = 7.5
-                    L = 1
-                    denominator = (nir + C1*red - C2*blue + L)
-                    evi = np.clip(np.where(denominator==0., 0, G*((nir-red)/denominator)), -1, 1)
-                    save_as_tiff(evi, red_src, make_filename(pattern, 'evi', info))
-                    
-    if indexname == 'reip':
-        with rasterio.open(make_filename(pattern, 'red', info)) as red_src:
-            with rasterio.open(make_filename(pattern, 'rededge1', info)) as re1_src:
-                with rasterio.open(make_filename(pattern, 'rededge2', info)) as re2_src:
-                    with rasterio.open(make_filename(pattern, 'rededge3', info)) as re3_src:
-                        red = red_src.read(1).astype('float64')
-                        re1 = re1_src.read(1).astype('float64')
-                        re2 = re2_src.read(1).astype('float64')
-                        re3 = re3_src.read(1).astype('float64')
-                        _, re1, _ = resample_to_same_shape(red, re1)
-                        _, re2, _ = resample_to_same_shape(red, re2)
-                        red, re3, final_shape = resample_to_same_shape(red, re3)
-                        denominator = (re2-re1)
-                        reip = np.where(denominator==0., 0, 700+40*(((red+re3)/2)-re1/denominator))
-                        metadata = Metadata(final_shape[1], final_shape[0], red_src.crs, red_src.transform)
-                        save_as_tiff(reip, metadata, make_filename(pattern, indexname, info))
-
-    if indexname == 'msavi':
-        with rasterio.open(make_filename(pattern, 'red', info)) as red_src:
-            with rasterio.open(make_filename(pattern, 'nir', info)) as nir_src:
-                red = red_src.read(1).astype('float64')
-                nir = nir_src.read(1).astype('float64')
-                radicand = np.square(2*nir+1) - 8*(nir-red)
-                msavi = np.where(radicand<0, 0, 2*nir+1-np.sqrt(radicand)/2)
-                save_as_tiff(msavi, red_src, make_filename(pattern, indexname, info))
-
-    return
-
-def create_composite(name, pattern, info):
-    if name == 'tci':
-        with rasterio.open(make_filename(pattern, 'red', info)) as red_src:
-            with rasterio.open(make_filename(pattern, 'green', info)) as green_src:
-                with rasterio.open(make_filename(pattern, 'blue', info)) as blue_src:
-                    red = red_src.read(1).astype('float64')
-                    green = green_src.read(1).astype('float64')
-                    blue = blue_src.read(1).astype('float64')
-                    save_as_tiff(np.array([red, green, blue]), red_src, make_filename(pattern, 'tci', info))
+# The index formulas below work on float arrays of the same shape, given in the order of BANDS_FOR_INDICES. They must
+# not modify their inputs (those are shared between all indices of a scene) and avoid full-size temporaries by
+# computing in place into the result array wherever possible.
+
+# numerator / denominator, computed in place into `numerator`, with 0 where the division is undefined
+def safe_divide(numerator, denominator):
+    undefined = (denominator == 0)
+    np.divide(numerator, denominator, out=numerator, where=~undefined)
+    numerator[undefined] = 0
+    return numerator
+
+def normalized_difference(band1, band2):
+    return safe_divide(np.subtract(band1, band2), np.add(band1, band2))
+
+def ratio(band1, band2):
+    return safe_divide(band1.copy(), band2)
+
+def vari(green, red, blue):
+    denominator = np.add(green, red)
+    denominator -= blue
+    return safe_divide(np.subtract(green, red), denominator)
+
+def evi(red, nir, blue):
+    G = 2.5
+    C1 = 6
+    C2 = 7.5
+    L = 1
+    # bands are in reflectance * 10000, the scaling is folded into the constants
+    denominator = np.multiply(red, C1)
+    denominator += nir
+    scratch = np.multiply(blue, C2)
+    denominator -= scratch
+    denominator += L * 10000
+    result = np.subtract(nir, red, out=scratch)
+    result *= G
+    return np.clip(safe_divide(result, denominator), -1, 1, out=result)
+
+def reip(red, re1, re2, re3):
+    denominator = np.subtract(re2, re1)
+    undefined = (denominator == 0)
+    result = np.divide(re1, denominator, out=denominator, where=~undefined)
+    np.subtract(np.add(red, re3, out=np.empty_like(result)) / 2, result, out=result)  # ((red+re3)/2) - re1/denominator
+    result *= 40
+    result += 700
+    result[undefined] = 0
+    return result
+
+def msavi(red, nir):
+    doubled_nir_plus_one = np.multiply(nir, 2)
+    doubled_nir_plus_one += 1
+    radicand = np.subtract(nir, red)
+    radicand *= -8
+    radicand += np.square(doubled_nir_plus_one)
+    negative = (radicand < 0)
+    result = np.sqrt(radicand, out=radicand, where=~negative)
+    result /= -2
+    result += doubled_nir_plus_one  # 2*nir+1 - sqrt(radicand)/2
+    result[negative] = 0
+    return result
+
+INDEX_FORMULAS = {
+    'ndvi':  normalized_difference,
+    'evi':   evi,
+    'ndyi':  normalized_difference,
+    'ngrdi': normalized_difference,
+    'ndre':  normalized_difference,
+    'msavi': msavi,
+    'vari':  vari,
+    'ndsi':  normalized_difference,
+    'msi':   ratio,
+    'reip':  reip,
+    'mois':  normalized_difference,
+}
 
+# `bands` maps band names to (array, Metadata) tuples as returned by `read_cog_subset` and has to contain all the ones
+# listed in BANDS_FOR_INDICES for `indexnames`. Each input band is converted to INDEX_DTYPE (and resampled onto `grid`,
+# by default the grid of the finest band of the respective index, with `resampling`, see `resample_to_grid`) only
+# once, no matter how many indices use it.
+# Yields (indexname, array, Metadata) tuples one after the other, so only one result has to be in memory at a time.
+def compute_indices(indexnames, bands, resampling='nearest', grid=None):
+    prepared = {}  # (bandname, grid) -> float array
+    remaining_uses = {}  # bandname -> number of indices still to come that need it
+    for indexname in indexnames:
+        for bandname in BANDS_FOR_INDICES[indexname]:
+            remaining_uses[bandname] = remaining_uses.get(bandname, 0) + 1
+    for indexname in indexnames:
+        bandnames = BANDS_FOR_INDICES[indexname]
+
+        # the band with the smallest pixels dictates the grid, the others are resampled onto it
+        finest = min(bandnames, key=lambda bandname: abs(bands[bandname][1].transform.a))
+        index_grid = grid or bands[finest][1]
+        grid_key = (index_grid.width, index_grid.height, tuple(index_grid.transform))
+
+        inputs = []
+        for bandname in bandnames:
+            if (bandname, grid_key) not in prepared:
+                with measure('resample'):
+                    prepared[(bandname, grid_key)] = resample_to_grid(*bands[bandname], index_grid, resampling, INDEX_DTYPE)
+            inputs.append(prepared[(bandname, grid_key)])
+
+        with measure('index'):
+            result = INDEX_FORMULAS[indexname](*inputs)
+        del inputs
+        for bandname in bandnames:  # free the converted bands as soon as no other index needs them
+            remaining_uses[bandname] -= 1
+            if remaining_uses[bandname] == 0:
+                for key in [key for key in prepared if key[0] == bandname]:
+                    del prepared[key]
+
+        yield indexname, result, Metadata(index_grid.width, index_grid.height, index_grid.crs, index_grid.transform)  # no nodata, 0 is a valid index value
+
+def calculate_indices(indexnames, bands, pattern, info, resampling='nearest'):
+    for indexname, result, metadata in compute_indices(indexnames, bands, resampling):
+        logging.info("Calculated " + indexname.upper())
+        save_output(result, metadata, pattern, indexname, info)
+
+def create_composite(name, bands, pattern, info):
+    if name == 'tci':
+        red, red_meta = bands['red']
+        green = bands['green'][0]
+        blue = bands['blue'][0]
+        with measure('composite'):
+            tci = np.stack([red, green, blue])  # keeps the dtype of the bands
+        save_output(tci, red_meta, pattern, 'tci', info)
+
+CLOUD_CLASSES = [0, 1, 2, 3, 8, 9, 10]  # no data, defective, topo shadows, cloud shadows, cloud medium prob, cloud high prob, thin cirrus
+
+# Number of pixels of each class in an SCL array
+def count_classes(scl):
+    return np.bincount(scl.ravel(), minlength=256)
+
+# Share of CLOUD_CLASSES given the pixel counts of all classes (None if there are no pixels)
+def get_cloud_share(counts):
+    total = counts.sum()
+    return counts[CLOUD_CLASSES].sum() / total if total else None
+
+# Share of CLOUD_CLASSES in an SCL array (None if it's empty)
+def get_cloud_cover(scl):
+    return get_cloud_share(count_classes(scl))
+
+# Cloud cover within the AOI of the SCL mosaic of `urls` (see `get_mosaic_grid`). Big AOIs (see TILED_MODE_PIXELS) are
+# counted tile by tile, so the SCL never has to be in memory as a whole.
+def fetch_cloud_cover(urls, bbox_4326, overview_level=None):
+    try:
+        header, window = get_mosaic_grid(urls, bbox_4326, overview_level)
+        if window.width * window.height > TILED_MODE_PIXELS:
+            tiles = iter_tiles(window, header['block_shape'])
+        else:
+            tiles = [Window(0, 0, window.width, window.height)]
+        counts = np.zeros(256, dtype='int64')
+        for tile in tiles:
+            scl, _ = fetch_mosaic_window(urls, header, Window(window.col_off + tile.col_off, window.row_off + tile.row_off, tile.width, tile.height), overview_level)
+            counts += count_classes(scl)
+    except rasterio.errors.RasterioIOError:
+        if overview_level is None:
+            raise
+        return None  # the COG doesn't have that overview
+    return get_cloud_share(counts)
+
+# Returns a list telling for each scene (a group of items, see `group_items`) whether its cloud cover within the bbox is
+# acceptable. It works in stages, each one only for the scenes the previous one couldn't decide:
+# 1. scenes whose `eo:cloud_cover` metadata is at least SCENE_CLOUD_COVER_REJECT percent are rejected without any download
+# 2. the SCL band is read from an overview (SCL_OVERVIEW_LEVEL, S2 COGs use nearest neighbour for SCL overviews, so the
+#    classes stay intact), which is a fraction of the full resolution data
+# 3. only if the result of that is within SCL_BORDERLINE_MARGIN of `max_cloud_cover`, the full resolution SCL is read
+# Scenes whose SCL can't be read are skipped as well and reported in `failures` (see `describe_failure`).
+def filter_cloudy_items(groups, bbox, max_cloud_cover, failures=None):
+    threshold = max_cloud_cover/100
+    keep = [True] * len(groups)
+    pending = []
+    for i, group in enumerate(groups):
+        scene_cloud_covers = [item.properties.get('eo:cloud_cover') for item in group]
+        scene_cloud_cover = None if None in scene_cloud_covers else min(scene_cloud_covers)  # the clearest of the tiles
+        if scene_cloud_cover is not None and scene_cloud_cover >= SCENE_CLOUD_COVER_REJECT and scene_cloud_cover > max_cloud_cover:
+            logging.info("Skipping scene due to cloud cover of the whole scene being " + str(int(scene_cloud_cover)) + "%")
+            keep[i] = False
+        else:
+            pending.append(i)
+
+    overview_levels = ([SCL_OVERVIEW_LEVEL] if SCL_OVERVIEW_LEVEL >= 0 else []) + [None]
+    for overview_level in overview_levels:
+        futures = {i: submit_download(fetch_cloud_cover, [item.assets['scl'].href for item in groups[i]], bbox, overview_level) for i in pending}
+        pending = []
+        for i, future in futures.items():
+            try:
+                cloud_cover = future.result()
+            except ReadError as err:
+                logging.warning("Skipping scene because its SCL can't be read: " + str(err))
+                keep[i] = False
+                if failures is not None:
+                    failures[get_scene_key(groups[i])] = describe_failure(groups[i], err)
+                continue
+            if overview_level is not None and (cloud_cover is None or abs(cloud_cover - threshold) <= SCL_BORDERLINE_MARGIN):
+                pending.append(i)  # too close to call at this resolution
+            elif cloud_cover is None or cloud_cover > threshold:
+                logging.info("Skipping scene due to cloud cover in AOI being " + ("unknown" if cloud_cover is None else str(int(cloud_cover*100)) + "%"))
+                keep[i] = False
+    return keep
+
+# GeoTIFF on `grid` that an output is written into tile by tile. It's kept next to the archive while it's written and
+# moved into the archive by `close`, after converting it to a COG if the job's output profile asks for one.
+class TiledOutput:
+    def __init__(self, name, grid, count, dtype, nodata, pattern, info):
+        self.arcname = make_filename(pattern, name, info)
+        self.filename = './jobs/' + info['jobname'] + '/' + name + '.part.tif'
+        self.profile = info['profile']
+        self.dtype = dtype
+        self.tiff = rasterio.open(
+            self.filename,
+            'w',
+            driver = 'GTiff',
+            width = grid.width,
+            height = grid.height,
+            count = count,
+            crs = grid.crs,
+            transform = grid.transform,
+            dtype = dtype,
+            nodata = nodata,
+            tiled = True,
+            blockxsize = 256,
+            blockysize = 256,
+        )
+
+    # `tile` is a window relative to the grid
+    def write(self, data, tile):
+        with measure('write') as measured:
+            self.tiff.write(data, 1 if data.ndim == 2 else list(range(1, data.shape[0]+1)), window=tile)
+            measured['bytes'] = data.nbytes
+
+    def close(self, archive):
+        self.tiff.close()
+        logging.info(self.arcname)
+        if OUTPUT_PROFILES[self.profile]['driver'] == 'COG':  # GDAL builds COGs by copying a finished dataset
+            cog_filename = self.filename.replace('.part.tif', '.part.cog.tif')
+            with measure('write'):
+                rasterio.shutil.copy(self.filename, cog_filename, **get_creation_options(self.profile, self.dtype))
+            os.replace(cog_filename, self.filename)
+        archive.add_file(self.arcname, self.filename, compressed=is_compressed(self.profile))
+        os.remove(self.filename)
+
+    # Throws away the file instead of adding it to the archive (if the scene fails)
+    def discard(self):
+        self.tiff.close()
+        os.remove(self.filename)
+
+# Extra pixels read around each tile from bands that are coarser than the grid of the output, so that resampling them
+# sees the same neighbours as for the whole AOI
+TILE_HALO = 2
+
+# Largest number of pixels of the AOI in any of the given bands of a scene (a group of items, see `group_items`), i.e.
+# on the finest grid among them
+def count_aoi_pixels(group, bandnames, bbox):
+    windows = [get_mosaic_grid([item.assets[band].href for item in group], bbox)[1] for band in bandnames]
+    return max([window.width * window.height for window in windows], default=0)
+
+# Identifies a scene (a group of items) across restarts of a job, see `JobStore`
+def get_scene_key(group):
+    return '+'.join(sorted(item.id for item in group))
+
+# Entry of the job report for a scene that was skipped because one of its COGs couldn't be read
+def describe_failure(group, err):
+    return {'ids': [item.id for item in group], 'url': getattr(err, 'url', None), 'error': str(err)}
+
+# Groups the items by acquisition (datatake and day, so the neighbouring MGRS tiles of one overpass end up together),
+# keeping their order. Within a group, the item covering most of the AOI comes first, the mosaic is made on its grids.
+def group_items(items, bbox):
+    groups = {}
+    for item in items:
+        key = (item.properties.get('s2:datatake_id', item.properties.get('platform')), str(item.datetime)[:10])
+        groups.setdefault(key, []).append(item)
+    for group in groups.values():
+        if len(group) > 1:
+            group.sort(key=lambda item: -count_aoi_pixels([item], ['scl'], bbox))
+    return list(groups.values())
+
+# One variable of a Datacube at time step `t`, which `process_item_tiled` writes into like into a TiledOutput
+class DatacubeLayer:
+    def __init__(self, cube, name, t):
+        self.cube = cube
+        self.name = name
+        self.t = t
+
+    def write(self, data, tile):
+        self.cube.write(self.name, self.t, data, tile)
+
+    def close(self, archive):
+        pass  # the data is in the cube already
+
+    def discard(self):
+        pass  # what's written stays, the rest of the time step is nodata
+
+# Produces the same outputs for a scene as the whole-array path in `process_job`, but for AOIs that are too big to be
+# held in memory at once. The outputs are grouped by the grid they are on (the native one for bands, the one of the
+# finest input band for indices, the one of red for composites). Each grid is walked tile by tile along the internal
+# blocks of its COGs: only the pixels of the input bands that cover the tile are read (plus TILE_HALO for coarser
+# bands), the outputs are computed for the tile and written into their place in a tiled GeoTIFF. The next tile is
+# downloaded while the current one is processed, so the memory needed doesn't depend on the size of the AOI.
+# With a `cube`, all outputs go onto its grid instead, tile by tile along its chunks, into its time step `t`.
+def process_item_tiled(group, bands_to_download, bands, indices, other, pattern, bbox, resampling, info, cube=None, t=None):
+    hrefs = {band: [item.assets[band].href for item in group] for band in bands_to_download}
+    headers, windows = {}, {}
+    for band in hrefs:
+        headers[band], windows[band] = get_mosaic_grid(hrefs[band], bbox)
+    def resolution(band):
+        return abs(headers[band]['transform'][0])
+    def grid_key(header, window):
+        return (header['crs'], tuple(header['transform']), tuple(window.flatten()))
+
+    outputs = {}  # name -> (band whose grid the output is on, bands it's computed from)
+    for band in bands:
+        outputs[band] = (band, [band])
+    for index in indices:
+        outputs[index] = (min(BANDS_FOR_INDICES[index], key=resolution), BANDS_FOR_INDICES[index])
+    if 'tci' in other:
+        outputs['tci'] = ('red', ['red', 'green', 'blue'])
+    groups = {}  # grid -> (header and window of the grid, names of the outputs on it)
+    if cube is None:
+        for name, (grid_band, _) in outputs.items():
+            groups.setdefault(grid_key(headers[grid_band], windows[grid_band]), (headers[grid_band], windows[grid_band], []))[2].append(name)
+    else:
+        groups[grid_key(cube.header, cube.window)] = (cube.header, cube.window, list(outputs))
+
+    for key, (header, window, names) in groups.items():
+        grid = window_metadata(header, window)
+        inputs = set(band for name in names for band in outputs[name][1])
+        group_indices = [index for index in indices if index in names]
+
+        files = {}
+        for name in names:
+            if cube is not None:
+                files[name] = DatacubeLayer(cube, name, t)
+            elif name in bands:
+                files[name] = TiledOutput(name, grid, 1, headers[name]['dtype'], headers[name]['nodata'], pattern, info)
+            elif name in INDEX_FORMULAS:
+                files[name] = TiledOutput(name, grid, 1, INDEX_DTYPE, None, pattern, info)
+            else:
+                files[name] = TiledOutput(name, grid, 3, headers['red']['dtype'], headers['red']['nodata'], pattern, info)  # keeps the dtype of the bands
+
+        def absolute_window(tile):
+            return Window(window.col_off + tile.col_off, window.row_off + tile.row_off, tile.width, tile.height)
+
+        def input_window(band, tile):
+            if grid_key(headers[band], windows[band]) == key:
+                return absolute_window(tile)
+            bounds = rasterio.windows.bounds(tile, grid.transform)
+            if headers[band]['crs'] != header['crs']:  # only in datacubes, for scenes from another UTM zone than the first
+                bounds = transform_bounds(grid.crs, CRS.from_wkt(headers[band]['crs']), *bounds)
+            return bounds_to_window(headers[band], bounds, TILE_HALO, windows[band])
+
+        def fetch_tile(tile):
+            return {band: submit_download(fetch_mosaic_window, hrefs[band], headers[band], input_window(band, tile)) for band in inputs}
+
+        if cube is None:
+            tiles = list(iter_tiles(window, header['block_shape']))
+        else:
+            tiles = list(iter_tiles(Window(0, 0, window.width, window.height), cube.chunk_shape))
+        next_futures = fetch_tile(tiles[0]) if tiles else None
+        try:
+            for n, tile in enumerate(tiles):
+                futures = next_futures
+                next_futures = fetch_tile(tiles[n+1]) if n+1 < len(tiles) else None
+                with measure('wait'):
+                    tile_bands = {band: future.result() for band, future in futures.items()}  # re-raises any download error
+                tile_grid = window_metadata(header, absolute_window(tile))
+                for name in names:
+                    if name in bands:
+                        data, metadata = tile_bands[name]
+                        files[name].write(resample_to_grid(data, metadata, tile_grid, resampling, data.dtype), tile)  # only datacubes need resampling
+                for indexname, result, _ in compute_indices(group_indices, tile_bands, resampling, tile_grid):
+                    files[indexname].write(result, tile)
+                if 'tci' in names:
+                    with measure('composite'):
+                        tci = np.stack([tile_bands[band][0] for band in ['red', 'green', 'blue']])
+                    files['tci'].write(tci, tile)
+                del tile_bands
+        except Exception:
+            for name in names:
+                files[name].discard()
+            raise
+
+        for name in names:
+            files[name].close(info['archive'])
+
+# Writes the requested bands, indices and composites of a scene, whose bands (all the ones needed) are in `item_bands`
+def process_scene(item_bands, bands, indices, other, pattern, info, resampling):
+    for band in bands:
+        save_output(*item_bands[band], pattern, band, info)
+    calculate_indices(indices, item_bands, pattern, info, resampling)
+    for name in other:
+        logging.info("Compositing " + name.upper())
+        create_composite(name, item_bands, pattern, info)
+
+# Stands in for the job's archive in the processes of the CPU pool, the files are added to the real one by the job
+class CollectedOutputs:
+    def __init__(self):
+        self.files = []  # (filename, content, compressed) tuples
+
+    def add(self, filename, content, compressed=False):
+        self.files.append((filename, content, compressed))
+
+# Copies the bands of a scene (band name -> (array, Metadata)) into one block of shared memory. Returns the block and
+# what `attach_bands` needs to find them in there.
+def share_bands(item_bands):
+    layout = []  # (band name, offset, shape, dtype, Metadata) tuples
+    size = 0
+    for band, (data, metadata) in item_bands.items():
+        layout.append((band, size, data.shape, data.dtype.str, metadata))
+        size += -(-data.nbytes // 64) * 64  # keeps every array aligned
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for band, offset, shape, dtype, _ in layout:
+        np.ndarray(shape, dtype, block.buf, offset)[...] = item_bands[band][0]
+    return block, layout
+
+# The bands shared by `share_bands`, as arrays backed by the shared memory. They must not be used after the `with` block.
+@contextmanager
+def attach_bands(name, layout):
+    block = shared_memory.SharedMemory(name)
+    item_bands = {band: (np.ndarray(shape, dtype, block.buf, offset), metadata) for band, offset, shape, dtype, metadata in layout}
+    try:
+        yield item_bands
+    finally:
+        item_bands.clear()  # no arrays may point into the block when it's closed
+        block.close()
+
+# `process_scene` in a process of the CPU pool, on bands shared by `share_bands`. Returns the outputs as
+# (filename, content, compressed) tuples for the job's archive and the Stats of the work (as `Stats.as_dict`).
+def process_shared_scene(name, layout, bands, indices, other, pattern, info, resampling):
+    stats = Stats()
+    current_stats.set((stats,))
+    outputs = CollectedOutputs()
+    with attach_bands(name, layout) as item_bands:
+        process_scene(item_bands, bands, indices, other, pattern, {**info, 'archive': outputs}, resampling)
+    return outputs.files, stats.as_dict()
+
+# Hands the bands of a scene over to the CPU pool (waiting while CPU_QUEUE scenes are in there already), the arguments
+# are the ones of `process_scene`. The future's result is the one of `process_shared_scene`.
+def submit_scene(item_bands, bands, indices, other, pattern, info, resampling):
+    with measure('cpu_wait'):
+        cpu_slots.acquire()
+    block, layout = share_bands(item_bands)
+    def release(future):
+        block.close()
+        block.unlink()
+        cpu_slots.release()
+    arguments = (process_shared_scene, block.name, layout, bands, indices, other, pattern, {**info, 'archive': None}, resampling)
+    pool = cpu_pool
+    try:
+        try:
+            future = pool.submit(*arguments)
+        except BrokenProcessPool:
+            future = restart_cpu_pool(pool).submit(*arguments)
+    except BaseException:
+        release(None)
+        raise
+    future.add_done_callback(release)
+    return future
+
+# The processes are forked right at the start, while there are no other threads whose locks they could inherit. They
+# share the parent's resource tracker, which would otherwise warn about the blocks of shared memory they attach to.
+def start_cpu_pool():
+    global cpu_pool
+    if CPU_WORKERS > 0:
+        resource_tracker.ensure_running()
+        cpu_pool = ProcessPoolExecutor(CPU_WORKERS, mp_context=multiprocessing.get_context('fork'))
+        cpu_pool.submit(os.getpid).result()  # starts all of them at once
+
+# If a process of the pool dies (e.g. killed for using too much memory or crashed in GDAL), the pool is broken for
+# good, so `broken` is replaced by a new one (unless another thread did that already). The scenes that were in there
+# fail, see `process_job`.
+def restart_cpu_pool(broken):
+    global cpu_pool
+    with cpu_pool_lock:
+        if cpu_pool is broken:
+            logging.error("A process of the CPU pool died, starting new ones")
+            count('cpu_pool_restarts')
+            broken.shutdown(wait=False, cancel_futures=True)
+            cpu_pool = ProcessPoolExecutor(CPU_WORKERS, mp_context=multiprocessing.get_context('fork'))
+        return cpu_pool
+
+# Processes one job after the other. A job that fails as a whole (e.g. because the catalog can't be searched) is marked
+# as 'failed' and the worker goes on with the next one.
 def run_worker():
     while True:
-        data = q.get()
-        logging.info(data)
-        logging.info("That was the worker")
-
-        bbox, start, end, max_cloud_cover, bands, indices, other, pattern, jobname = data.values()
-        logging.info(jobname)
-        search = get_search_result(bbox, start, end)
-
-        global current_job
-        global percentage
-        current_job = jobname
-        percentage = 0
-        counter = 0
-        total_items = search.matched()
-
-        os.mkdir('./jobs/' + jobname)
-
-        f = open('./jobs/' + jobname + "/" + jobname + ".txt", "a") 
-        f.write(json.dumps(data))
-        f.close()
-
-        bands_explicitly_requested = set(bands)
-        bands_implicitly_needed = set()
-        for index in indices:
-            bands_implicitly_needed |= set(BANDS_FOR_INDICES[index])
-        if 'tci' in other:
-            bands_implicitly_needed |= set(['red', 'green', 'blue'])
-        bands_to_download = bands_explicitly_requested | bands_implicitly_needed  # union of all
-        bands_to_delete_later = bands_to_download - bands_explicitly_requested  # only keep those that were explicitly requested
-
-        CLOUD_CLASSES = [0, 1, 2, 3, 8, 9, 10]  # no data, defective, topo shadows, cloud shadows, cloud medium prob, cloud high prob, thin cirrus
-
-        for item in search.items():
-            counter += 1
-            percentage = round(counter / total_items * 100)
-            yymmdd = str(item.datetime)[2:10].replace('-', '')
-            tile = str(item.properties['mgrs:utm_zone']) + item.properties['mgrs:latitude_band'] + item.properties['mgrs:grid_square']
-            info = {'yymmdd': yymmdd, 'tile': tile, 'jobname': jobname}
-            if max_cloud_cover:
-                scl = save_cog_subset(item.assets['scl'].href, bbox, None)   # get cog subset without writing to disk (filename=None)
-                classes, counts = np.unique(scl, return_counts=True)
-                cloud_counts = [x[1] for x in zip(classes, counts) if x[0] in CLOUD_CLASSES]
-                cloud_cover = sum(cloud_counts)/sum(counts)
-                if cloud_cover > max_cloud_cover/100:
-                    logging.info("Skipping scene due to cloud cover in AOI being " + str(int(cloud_cover*100)) + "%")
-                    continue
-            for band in bands_to_download:
-                filename = make_filename(pattern, band, info)
-                logging.info(filename)
-                save_cog_subset(item.assets[band].href, bbox, filename)
-            for index in indices:
-                logging.info("Calculating " + index.upper())
-                calculate_index(index, pattern, info)
-            for item in other:
-                logging.info("Compositing " + item.upper())
-                create_composite(item, pattern, info)
-            for band in bands_to_delete_later:
-                filename = make_filename(pattern, band, info)
-                os.remove(filename)
-
-        logging.info('Zipping...')
-        shutil.make_archive('./jobs/'+jobname, 'zip', './jobs/'+jobname)
-        shutil.move('./jobs/'+jobname+'.zip', './jobs/'+jobname+'/'+jobname+'.zip')
-        logging.info('Finished!')
-        current_job = None
-        percentage = None
+        _, jobname = q.get()
+        set_job_progress(jobname, state='processing', percentage=0, started=datetime.now().timestamp())
+        try:
+            with measure('job'):
+                process_job(jobs[jobname]['data'], jobs[jobname].get('items'))
+        except Exception:
+            logging.exception("Job " + jobname + " failed")
+            current_stats.set(())
+            metrics.count('jobs_failed')
+            set_job_progress(jobname, state='failed', percentage=None, items=None)
+            continue
+        metrics.count('jobs_finished')
+        set_job_progress(jobname, state='finished', percentage=None, items=None)
+
+# `items` are the ones found when the job was ordered, if they are missing the search is done (again)
+def process_job(data, items=None):
+    logging.info(data)
+    logging.info("That was the worker")
+
+    bbox, start, end, max_cloud_cover, bands, indices, other, pattern, jobname = [data[key] for key in ['bbox', 'start', 'end', 'max_cloud_cover', 'bands', 'indices', 'other', 'pattern', 'jobname']]
+    resampling = data.get('resampling', 'nearest')  # optional, nearest is what jobs got before they could choose
+    profile = data.get('output_profile', OUTPUT_PROFILE)  # optional
+    output_format = data.get('output_format', 'geotiff')  # optional
+    logging.info(jobname)
+    if any(os.path.isfile('./jobs/' + jobname + '/' + jobname + extension) for extension in DOWNLOAD_TYPES):  # finished right before a restart
+        job_store.delete_checkpoints(jobname)
+        return
+    started = time.perf_counter()
+    job_stats = Stats()
+    current_stats.set((job_stats,))
+    if items is None:
+        items = search_items(bbox, start, end)
+    # neighbouring tiles of the same acquisition are processed together as one mosaic
+    groups = group_items(items, bbox)
+    if output_format == 'netcdf':  # they are appended to the time axis in this order
+        groups.sort(key=lambda group: group[0].datetime)
+    item_stats = [Stats() for group in groups]
+    item_seconds = [None] * len(groups)
+
+    os.makedirs('./jobs/' + jobname, exist_ok=True)  # exists already if the job is resumed
+
+    f = open('./jobs/' + jobname + "/" + jobname + ".txt", "w") 
+    f.write(json.dumps(data))
+    f.close()
+
+    # an interrupted job continues after the last scene that made it into its archive (NetCDF files can't be
+    # continued, those jobs start over)
+    checkpoints = []
+    archive = None
+    if output_format == 'geotiff':
+        checkpoints = job_store.get_checkpoints(jobname)
+        if checkpoints and os.path.isfile('./jobs/' + jobname + '/' + jobname + '.zip.part'):
+            archive, valid = JobArchive.resume(jobname, checkpoints)
+            logging.info("Resuming " + jobname + " after " + str(valid) + " of " + str(len(checkpoints)) + " checkpoints")
+            job_store.truncate_checkpoints(jobname, valid)
+            checkpoints = checkpoints[:valid]
+        else:
+            job_store.delete_checkpoints(jobname)
+            checkpoints = []
+            archive = JobArchive(jobname)
+        if '' not in [scene for scene, _, _, _ in checkpoints]:
+            archive.add(jobname + ".txt", json.dumps(data), compressed=False)
+            job_store.add_checkpoint(jobname, '', True, *archive.checkpoint())
+    done = {scene: processed for scene, processed, _, _ in checkpoints}
+    resumed = [get_scene_key(group) in done for group in groups]
+    failures = {}  # scene -> what went wrong, see `describe_failure`
+
+    bands_explicitly_requested = set(bands)
+    bands_implicitly_needed = set()
+    for index in indices:
+        bands_implicitly_needed |= set(BANDS_FOR_INDICES[index])
+    if 'tci' in other:
+        bands_implicitly_needed |= set(['red', 'green', 'blue'])
+    bands_to_download = bands_explicitly_requested | bands_implicitly_needed  # union of all, only the explicitly requested ones end up in the archive
+
+    total_items = len(groups)
+    infos = []
+    for group in groups:
+        yymmdd = str(group[0].datetime)[2:10].replace('-', '')
+        tiles = [str(item.properties['mgrs:utm_zone']) + item.properties['mgrs:latitude_band'] + item.properties['mgrs:grid_square'] for item in group]
+        tile = '_'.join(sorted(set(tiles)))  # e.g. 32UQE_33UUV for a mosaic
+        infos.append({'yymmdd': yymmdd, 'tile': tile, 'jobname': jobname, 'archive': archive, 'profile': profile})
+
+    # first find out which scenes are worth downloading at all (the ones done before a restart were decided on already)
+    pending = [group for i, group in enumerate(groups) if not resumed[i]]
+    with measure('cloud_filter'):
+        pending_keep = iter(filter_cloudy_items(pending, bbox, max_cloud_cover, failures) if max_cloud_cover else [True] * len(pending))
+    keep = [done[get_scene_key(group)] if resumed[i] else next(pending_keep) for i, group in enumerate(groups)]
+
+    cube = None
+    if output_format == 'netcdf':
+        if 'tci' in other:  # the composite is just its bands in the cube
+            bands = bands + [band for band in ['red', 'green', 'blue'] if band not in bands]
+            other = []
+        cube = create_datacube(jobname, [group for i, group in enumerate(groups) if keep[i]], bands_to_download, bands, indices, bbox, data)
+
+    # AOIs too big for whole arrays are processed tile by tile (all scenes cover the same bbox, so the first one tells)
+    tiled = len(groups) > 0 and count_aoi_pixels(groups[0], bands_to_download, bbox) > TILED_MODE_PIXELS
+
+    # then queue the bands of the remaining scenes, the pool takes care of the concurrency limits
+    # only PREFETCH_ITEMS scenes are in flight at any time because their bands are kept in memory until processed, and
+    # each of them takes one of the `prefetch_slots` until then. They are queued in order, and the job only waits for a
+    # slot for the scene it is at (when it doesn't hold any), so jobs can't block each other for good.
+    band_futures = [None] * len(groups)
+    holding = set()  # scenes with a slot
+    next_prefetch = 0
+    def prefetch(limit, current=None):
+        nonlocal next_prefetch
+        while next_prefetch < min(limit, len(groups)):
+            i = next_prefetch
+            if keep[i] and not resumed[i] and not tiled:
+                if not prefetch_slots.acquire(blocking=i == current):
+                    return  # try again at the next scene
+                holding.add(i)
+                band_futures[i] = {band: submit_download(fetch_mosaic_subset, [item.assets[band].href for item in groups[i]], bbox, stats=(job_stats, item_stats[i])) for band in bands_to_download}
+            next_prefetch += 1
+    def release_slot(i):
+        if i in holding:
+            holding.remove(i)
+            prefetch_slots.release()
+    try:
+        prefetch(PREFETCH_ITEMS)
+
+        # the outputs of whole scenes are computed in the CPU pool (unless there is none), while the job goes on with the
+        # next scenes. Those still in there are kept in `unfinished` as (index, start time, future) tuples, together with
+        # the scenes after them that didn't need the pool, so that all are finished (i.e. in the archive and checkpointed)
+        # in their original order.
+        use_cpu_pool = cpu_pool is not None and cube is None and not tiled
+        unfinished = deque()
+
+        def finish(i, item_started, future):
+            group = groups[i]
+            current_stats.set((job_stats, item_stats[i]))
+            if future is not None:
+                try:
+                    with measure('cpu_wait'):
+                        outputs, stats = future.result()
+                except BrokenProcessPool as err:  # its bands are gone, so it's skipped like a scene that can't be read
+                    logging.warning("Skipping scene because its process of the CPU pool died")
+                    failures[get_scene_key(group)] = describe_failure(group, err)
+                    keep[i] = False
+                else:
+                    add_stats(stats)
+                    for filename, content, compressed in outputs:
+                        archive.add(filename, content, compressed=compressed)
+            if keep[i] and not resumed[i]:
+                count('scenes_processed')
+                item_seconds[i] = time.perf_counter() - item_started
+            if archive is not None and not resumed[i] and get_scene_key(group) not in failures:  # failed scenes are tried again if the job is resumed
+                job_store.add_checkpoint(jobname, get_scene_key(group), keep[i], *archive.checkpoint())
+            current_stats.set((job_stats,))
+            set_job_progress(jobname, percentage=round((i + 1) / total_items * 100))
+
+        # and process the scenes in their original order as soon as their bands have arrived
+        for i, group in enumerate(groups):
+            info = infos[i]
+            prefetch(i + PREFETCH_ITEMS, current=i)
+            item_started = time.perf_counter()
+            future = None
+            if not resumed[i]:  # otherwise in the archive already
+                current_stats.set((job_stats, item_stats[i]))
+                try:
+                    if keep[i] and tiled:
+                        t = cube.append(group[0].datetime.timestamp(), info['tile']) if cube is not None else None
+                        process_item_tiled(group, bands_to_download, bands, indices, other, pattern, bbox, resampling, info, cube, t)
+                    elif keep[i]:
+                        with measure('wait'):
+                            item_bands = {band: band_future.result() for band, band_future in band_futures[i].items()}  # re-raises any download error
+                        band_futures[i] = True  # releases the futures (and thereby the arrays) once this iteration is done
+                        if cube is not None:
+                            add_to_datacube(cube, cube.append(group[0].datetime.timestamp(), info['tile']), item_bands, bands, indices, resampling)
+                        elif use_cpu_pool:
+                            future = submit_scene(item_bands, bands, indices, other, pattern, info, resampling)
+                        else:
+                            process_scene(item_bands, bands, indices, other, pattern, info, resampling)
+                        del item_bands
+                except ReadError as err:  # even after retrying, the rest of the job goes on without this scene
+                    logging.warning("Skipping scene because a COG can't be read: " + str(err))
+                    failures[get_scene_key(group)] = describe_failure(group, err)
+                    keep[i] = False
+                    band_futures[i] = True
+                    if archive is not None:
+                        archive.rollback()
+                release_slot(i)
+                current_stats.set((job_stats,))
+            unfinished.append((i, item_started, future))
+            while unfinished and (unfinished[0][2] is None or unfinished[0][2].done() or len(unfinished) > CPU_QUEUE):
+                finish(*unfinished.popleft())
+        while unfinished:
+            finish(*unfinished.popleft())
+    finally:
+        for i in list(holding):
+            release_slot(i)
+
+    if cube is not None:
+        cube.close()
+    else:
+        archive.close()
+    job_store.delete_checkpoints(jobname)
+    current_stats.set(())
+    write_report(jobname, time.perf_counter() - started, job_stats, groups, keep, resumed, failures, item_stats, item_seconds)
+    logging.info('Finished!')
+
+# Writes the timings and byte counts of a job to `<jobname>.report.json` next to its `.txt`. The seconds of the stages
+# are summed over all threads that worked on the job, so with concurrent downloads they add up to more than `seconds`.
+# There's one entry per scene in `per_item`, with the ids of all items of mosaics. Scenes that were done before the job
+# was resumed have no timings. `failures` lists the scenes that were skipped because a COG couldn't be read.
+def write_report(jobname, seconds, job_stats, groups, keep, resumed, failures, item_stats, item_seconds):
+    report = {
+        'jobname': jobname,
+        'seconds': seconds,
+        'items': sum(len(group) for group in groups),
+        'scenes': len(groups),
+        'scenes_processed': sum(keep),
+        'scenes_resumed': sum(resumed),
+        'scenes_failed': len(failures),
+        'failures': list(failures.values()),
+        **job_stats.as_dict(),
+        'per_item': [{'ids': [item.id for item in group], 'processed': keep[i], 'resumed': resumed[i], 'failed': get_scene_key(group) in failures, 'seconds': item_seconds[i], **item_stats[i].as_dict()} for i, group in enumerate(groups)],
+    }
+    with open('./jobs/' + jobname + '/' + jobname + '.report.json', 'w') as f:
+        json.dump(report, f, indent=1)
 
 
 ###############################################################################
 
 
 if __name__ == '__main__':
+    start_cpu_pool()
+    resume_jobs()
+    ui_files.load()
+
     t1 = Thread(target = run_server)
     t1.start()
 
-    t2 = Thread(target = run_worker)
-    t2.start()
+    for i in range(JOB_WORKERS):
+        Thread(target = run_worker, name = 'worker-' + str(i)).start()